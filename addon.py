@@ -1,26 +1,34 @@
 # -*- coding: utf-8 -*-
 # Copyright 2016 Nate Bogdanowicz
+import time
+start_time = time.time()
+
 import sys
 import os
 import os.path
+import json
 import logging
 import urlparse
+import threading
 import datetime
-from collections import OrderedDict
 from urllib import urlencode
-from PIL import Image
 import xbmc
 import xbmcgui
+import xbmcaddon
 import xbmcplugin
 import mlb
+import artwork
+import downloads
+import resident
+import tracing
 
 
 # Directories
-tmp_dir = xbmc.translatePath('special://temp/mlbtv')
 img_dir = os.path.join(mlb.addon_dir, 'resources', 'images')
+fanart_dir = os.path.join(img_dir, 'fanart')
 
-if not os.path.exists(tmp_dir):
-    os.makedirs(tmp_dir)
+art_store = artwork.open_store(img_dir, mlb.profile_dir)
+_fanart_names = None
 
 
 color = {
@@ -54,6 +62,15 @@ if __name__ == '__main__':
     log = logging.getLogger()
     log.addHandler(KodiHandler())
     log.setLevel(logging.INFO)
+    if mlb.get_settings().get('debug') == 'Debug':
+        log.setLevel(logging.DEBUG)
+    profiler = None
+    if mlb.get_settings().get('debug', 'Off') not in ('', 'Off'):
+        mlb.enable_tracing()
+        tracing.record('startup', start_time)
+        if mlb.get_settings().get('profile_next') == 'true':
+            import profiling
+            profiler = profiling.Profiler().start()
 
 
 class Addon(object):
@@ -91,114 +108,193 @@ class Addon(object):
         xbmcplugin.endOfDirectory(self.handle)
 
 
-def join_images(path_1, path_2, out_path, margin=0, spacing=0, alpha=0.):
-    img_1 = Image.open(path_1)
-    img_2 = Image.open(path_2)
+def poster_img(home_code, away_code):
+    return art_store.path(home_code, away_code, 'poster')
 
-    width = img_1.size[0] + img_2.size[0] + 2 * margin + spacing
-    height = max(img_1.size[1], img_2.size[1]) + 2 * margin
 
-    s = int(0.5 * 255)
-    new_img = Image.new('RGBA', (width, height), (s, s, s, int(alpha*255)))
-    new_img.paste(img_1, (margin,
-                          int((height - img_1.size[1])/2)), img_1)
-    new_img.paste(img_2, (margin + spacing + img_1.size[0],
-                          int((height - img_2.size[1])/2)), img_2)
+def thumb_img(home_code, away_code):
+    return art_store.path(home_code, away_code, 'thumb')
 
-    new_img.save(out_path)
+
+def fanart_path(team_code):
+    global _fanart_names
+    if _fanart_names is None:
+        _fanart_names = set(os.listdir(fanart_dir)) if os.path.isdir(fanart_dir) else set()
+    fname = '{}.jpg'.format(team_code)
+    return os.path.join(fanart_dir, fname if fname in _fanart_names else 'default.jpg')
+
+
+class ListingState(object):
+    """Compact per-game render state from the previous listing of a date.
+
+    Each game is stored as its compact label_state list plus the label it was rendered with,
+    so refreshing a listing only rebuilds the games whose state changed. Artwork is not
+    stored: it is looked up in the artwork store every time, which marks it as used.
+    """
+    MAX_DATES = 7
+
+    def __init__(self, state_dir, date):
+        self.state_dir = state_dir
+        self.path = os.path.join(state_dir, date.strftime('%Y-%m-%d.json'))
+        try:
+            with open(self.path) as f:
+                self.previous = json.load(f)
+        except (IOError, ValueError):
+            self.previous = {}
+        self.current = {}
+
+    def get(self, key, state):
+        """Return the stored item for `key` if the game is still in `state`"""
+        entry = self.previous.get(key)
+        if entry is not None and entry['state'] == state:
+            self.current[key] = entry
+            return entry['item']
+        return None
+
+    def put(self, key, state, item):
+        self.current[key] = {'state': state, 'item': item}
+
+    def changed(self):
+        return [key for key in self.current if key not in self.previous or
+                self.previous[key]['state'] != self.current[key]['state']]
+
+    def save(self):
+        if self.current == self.previous:
+            return
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+        with open(self.path, 'w') as f:
+            json.dump(self.current, f)
+
+        paths = sorted((os.path.join(self.state_dir, fname)
+                        for fname in os.listdir(self.state_dir)), key=os.path.getmtime)
+        for path in paths[:-self.MAX_DATES]:
+            os.remove(path)
+
+
+STATUS_LABEL = {
+    'Warmup': 'Warmup',
+    'In Progress': 'Live',
+    'Game Over': 'Game Over',
+    'Final': 'Archived'
+}
+CATEGORIES = ('In Progress', 'Warmup', 'Pre-Game', 'Game Over', 'Final')
 
 
-def joined_img(home_code, away_code, name, src_dir, margin, spacing, alpha):
-    img_path = os.path.join(tmp_dir, '{}_{}_{}.png'.format(home_code, away_code, name))
-    if os.path.exists(img_path):
-        return img_path
+def game_item(g):
+    """Build the label, arguments and artwork of a game's list item"""
+    return dict(game_label(g), art=game_art(g))
 
-    home_path = os.path.join(src_dir, '{}.png'.format(home_code))
-    away_path = os.path.join(src_dir, '{}.png'.format(away_code))
-    join_images(home_path, away_path, img_path, margin, spacing, alpha)
-    return img_path
 
+def game_label(g):
+    """Build the label and arguments of a game's list item"""
+    status_str = g.time if g.category == 'Pre-Game' else STATUS_LABEL.get(g.status, 'Unknown')
+    STR = "[COLOR={}]{}[/COLOR] - {} [COLOR=FFAAAAAA]vs[/COLOR] {}"
+    label = STR.format(color.get(g.status, 'FFFFFFFF'), status_str, g.home_team_name,
+                       g.away_team_name)
 
-def poster_img(home_code, away_code):
-    return joined_img(home_code, away_code, 'poster', os.path.join(img_dir, 'logos', 'scaled'),
-                      10, 20, 0.0)
+    playable = 'true' if g.status in ('In Progress', 'Final') else 'false'
+    return {'label': label, 'args': {'mode': 'game', 'event_id': g.event_id},
+            'playable': playable}
 
 
-def thumb_img(home_code, away_code):
-    return joined_img(home_code, away_code, 'thumb', os.path.join(img_dir, 'logos', 'icons'),
-                      2, 4, 0.0)
+def label_state(g):
+    """Every input of game_label: the game's live state, plus the start time and event id,
+    which can also change (a rescheduled start, media published after the first listing)"""
+    return g.state + [g.time, g.event_id, g.home_team_name, g.away_team_name]
 
 
-def fanart_path(team_code):
-    path = os.path.join(img_dir, 'fanart', '{}.jpg'.format(team_code))
-    if not os.path.exists(path):
-        return os.path.join(img_dir, 'fanart', 'default.jpg')
-    return path
+def game_art(g):
+    return {'fanart': fanart_path(g.home_file_code),
+            'banner': poster_img(g.home_file_code, g.away_file_code),
+            'thumb': thumb_img(g.home_file_code, g.away_file_code)}
 
 
 def show_games(date):
-    categories = ('In Progress', 'Warmup', 'Pre-Game', 'Game Over', 'Final')
-    normal_groups = OrderedDict((category, []) for category in categories)
-    fav_groups = OrderedDict((category, []) for category in categories)
-    # label, args, isFolder
-
-    for g in mlb.get_games(date):
-        status = g['status']['status']  # 'In Progress', 'Final', 'Preview', 'Pre-Game', 'Game Over'
-        log.info(status)
-        status = 'Pre-Game' if status == 'Preview' else status
-
-        if status not in categories:
-            log.error("Unknown game status '{}'".format(status))
+    fav_team_ids = set(mlb.get_settings()['fav_team_ids'])
+    buckets = {}
+    for g in resident.call('get_games', date):
+        if g.category not in CATEGORIES:
+            log.error("Unknown game status '{}'".format(g.status))
             continue
+        is_fav = g.home_team_id in fav_team_ids or g.away_team_id in fav_team_ids
+        buckets.setdefault((not is_fav, CATEGORIES.index(g.category)), []).append(g)
 
-        fav_team_ids = mlb.settings['fav_team_ids']
-        if g['home_team_id'] in fav_team_ids or g['away_team_id'] in fav_team_ids:
-            fav_groups[status].append(g)
-        else:
-            normal_groups[status].append(g)
+    incremental = mlb.get_settings().get('incremental_refresh') != 'false'
+    listing = ListingState(os.path.join(mlb.profile_dir, 'listings'), date) if incremental else None
 
     items = []
-    for groups in (fav_groups, normal_groups):
-        for group in groups.values():
-            def sort_key(game):
-                hour_str, min_str = game['time'].split(':')
-                is_pm = game['ampm'].lower() == 'pm'
-                return (int(hour_str) + 12*int(is_pm), int(min_str), game['home_team_name'])
-
-            for g in sorted(group, key=sort_key):
-                media = g['game_media']['media']
-                if isinstance(media, list):
-                    media = media[0]
-                event_id = media['calendar_event_id']
-                time = g['time'] + ' ' + g['ampm']
-
-                STATUS_LABEL = {
-                    'Pre-Game': time,
-                    'Preview': time,
-                    'Warmup': 'Warmup',
-                    'In Progress': 'Live',
-                    'Game Over': 'Game Over',
-                    'Final': 'Archived'
-                }
-
-                status = g['status']['status']
-                status_str = STATUS_LABEL.get(status, 'Unknown')
-                STR = "[COLOR={}]{}[/COLOR] - {} [COLOR=FFAAAAAA]vs[/COLOR] {}"
-                label = STR.format(color.get(status, 'FFFFFFFF'), status_str, g['home_team_name'],
-                                   g['away_team_name'])
-
-                playable = 'true' if status in ('In Progress', 'Final') else 'false'
-                art = {'fanart': fanart_path(g['home_file_code']),
-                       'banner': poster_img(g['home_file_code'], g['away_file_code']),
-                       'thumb': thumb_img(g['home_file_code'], g['away_file_code'])}
-                item = addon.add_list_item(label, args={'mode': 'game', 'event_id': event_id},
-                                           isFolder=False, properties={'IsPlayable': playable},
-                                           art=art)
-                items.append(item)
-
+    for bucket in sorted(buckets):
+        for g in sorted(buckets[bucket], key=lambda g: (g.start_minute, g.home_team_name)):
+            if listing is None:
+                spec = game_label(g)
+            else:
+                state = label_state(g)
+                spec = listing.get(g.game_id, state)
+                if spec is None:
+                    spec = game_label(g)
+                    listing.put(g.game_id, state, spec)
+
+            item = addon.add_list_item(spec['label'], args=spec['args'], isFolder=False,
+                                       properties={'IsPlayable': spec['playable']},
+                                       art=game_art(g))
+            items.append(item)
+
+    if listing is not None:
+        log.info("Changed games: {}".format(', '.join(listing.changed()) or 'none'))
+        listing.save()
+    art_store.save(mlb.artwork_cache_bytes())
     return items
 
 
+def feed_prefetch_ids(date):
+    """Return the event ids of the games on `date` likely to be opened next: those in
+    progress and those of favourite teams"""
+    fav_team_ids = set(mlb.get_settings()['fav_team_ids'])
+    return [g.event_id for g in resident.call('get_games', date)
+            if g.event_id and (g.status in mlb.ScoreboardCache.LIVE_STATUSES or
+                               g.home_team_id in fav_team_ids or
+                               g.away_team_id in fav_team_ids)]
+
+
+def show_teams():
+    fav_team_ids = mlb.get_settings()['fav_team_ids']
+    teams = sorted(mlb.TEAM_CODES.items(), key=lambda kv: (kv[0] not in fav_team_ids, kv[1][0]))
+    for team_id, (name, file_code) in teams:
+        addon.add_list_item(name, args={'mode': 'team_schedule', 'team_id': team_id},
+                            art={'fanart': fanart_path(file_code)}, isFolder=True)
+
+
+def show_team_schedule(team_id):
+    games = resident.call('get_team_games', team_id)
+    for date, g in sorted(games, key=lambda dg: (dg[0], dg[1].start_minute), reverse=True):
+        spec = game_item(g)
+        addon.add_list_item(date.strftime('%a %m/%d') + ' - ' + spec['label'], args=spec['args'],
+                            isFolder=False, properties={'IsPlayable': spec['playable']},
+                            art=spec['art'])
+    art_store.save(mlb.artwork_cache_bytes())
+
+
+def show_downloads():
+    addon.add_list_item('Queue Favourite Team Archives', args={'mode': 'queue_favourites'},
+                        isFolder=True)
+    for job in sorted(resident.call('list_downloads'), key=lambda job: -job['added']):
+        label = '[{}] {}'.format(job['state'].capitalize(), job['name'])
+        playable = job['state'] == downloads.DONE and os.path.exists(job['path'])
+        if job['state'] == downloads.ACTIVE:
+            label += ' ({:.0%})'.format(downloads.progress(job))
+        elif job.get('error'):
+            label += ' - ' + job['error']
+        elif job['state'] == downloads.DONE and not playable:
+            label += ' - File deleted'
+        if playable:
+            addon.add_list_item(label, url=job['path'], isFolder=False,
+                                properties={'IsPlayable': 'true'})
+        else:
+            # Nothing to play; opening it just refreshes the list
+            addon.add_list_item(label, args={'mode': 'downloads'}, isFolder=True)
+
+
 def parse_date(date_str):
     """Parse simple %Y-%m-%d string into a date. Needed b/c strptime fails with Kodi"""
     return datetime.date(*(int(n) for n in date_str.split('-')))
@@ -223,28 +319,85 @@ if __name__ == '__main__':
         #     addon.add_list_item(next_day.strftime("%A's Games"), iconImage='scroll-right.png',
         #                         args={'mode': 'main_menu', 'date': next_day.strftime(fmt)},
         #                         isFolder=True)
+        addon.add_list_item('Team Schedule', args={'mode': 'teams'}, isFolder=True)
+        addon.add_list_item('Downloads', args={'mode': 'downloads'}, isFolder=True)
+        prefetch_days = int(mlb.get_settings().get('prefetch_days') or 0)
+        prefetch = None
+        if prefetch_days:
+            prefetch = resident.call('prefetch_games', date, prefetch_days)
         show_games(date)
         addon.end_directory()
+        feeds = None
+        if mlb.get_settings().get('prefetch_feeds') == 'true':
+            feeds = resident.call('prefetch_game_videos', feed_prefetch_ids(date))
+        for thread in (prefetch, feeds):
+            if thread:
+                thread.join()
+    elif mode == 'teams':
+        show_teams()
+        addon.end_directory()
+    elif mode == 'team_schedule':
+        show_team_schedule(addon.args['team_id'])
+        addon.end_directory()
+    elif mode == 'downloads':
+        show_downloads()
+        addon.end_directory()
+    elif mode == 'queue_favourites':
+        log.info("Queued {} archives".format(resident.call('queue_favourites')))
+        show_downloads()
+        addon.end_directory()
     elif mode == 'game':
-        content = mlb.get_game_video(addon.args['event_id'])
+        content = resident.call('get_game_video', addon.args['event_id'])
         log.info(content)
 
-        fav_team_ids = mlb.settings['fav_team_ids']
+        fav_team_ids = mlb.get_settings()['fav_team_ids']
         preferred_ids = [b_id for b_id in content['video'] if b_id in fav_team_ids]
         xbmc.log(str(content))
+        resolver = None
         if len(preferred_ids) == 1:
             content_tup = content['video'][preferred_ids[0]][0]
         else:
             names = []
             content_tups = []
+            eager_tups = []
+            eager = mlb.get_settings().get('eager_resolve') or 'Off'
             for kind in ('video', 'audio'):
-                for tup in content['video'].values():
-                    names.append(tup[0])
-                    content_tups.append(tup)
+                for coverage_id, tups in content[kind].items():
+                    for tup in tups:
+                        names.append(tup[0])
+                        content_tups.append(tup)
+                        if eager == 'All' or (eager == 'Favourites' and
+                                              coverage_id in fav_team_ids):
+                            eager_tups.append(tup)
+
+            # Resolve the likely picks while the user is still choosing
+            if eager_tups:
+                resolver = threading.Thread(target=resident.call,
+                                            args=('resolve_game_urls', eager_tups))
+                resolver.start()
 
             dialog = xbmcgui.Dialog()
             ret = dialog.select('Choose Broadcast', names)
             content_tup = content_tups[ret] if ret >= 0 else None
+            # Only wait for the pick's own resolution; any other feed is resolved right away
+            if resolver and content_tup in eager_tups:
+                resolver.join()
 
-        url = mlb.get_game_url(*content_tup)
-        addon.set_resolved_url(url)
+        if content_tup is None:
+            addon.set_resolved_url('', success=False)  # Dialog cancelled
+        else:
+            url = resident.call('get_game_url', *content_tup)
+            addon.set_resolved_url(url)
+        if resolver:
+            resolver.join()  # Playback has started; let the rest be cached before exiting
+
+    mlb.save_cookies()
+    tracing.emit()
+    if mlb.get_settings().get('trace_file') == 'true':
+        tracing.write_trace(os.path.join(mlb.profile_dir, 'trace.json'))
+    if profiler:
+        profiler.stop()
+        path = profiler.write(os.path.join(mlb.profile_dir, 'profiles'),
+                              '{}-{}'.format(mode, time.strftime('%Y%m%d-%H%M%S')))
+        log.info("Wrote profile of this invocation to {}.*".format(path))
+        xbmcaddon.Addon().setSetting('profile_next', 'false')  # Capture only one invocation
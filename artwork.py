@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Matchup artwork, composed from pairs of team logos.
+
+Composed images live in an artwork store: a directory of PNGs plus a JSON manifest mapping
+(home, away, style) to a file name, its size and when it was last used, so listings resolve
+artwork with a dict lookup. Stores may be size-capped, evicting least recently used images.
+Logos are decoded once per process and kept in a sprite cache. PIL is only imported once an
+image actually has to be composed.
+
+Many images are best rendered with render_batch(). With NumPy installed, it blends each logo
+onto its half of the background once per batch, so each matchup only costs a concatenation
+and a PNG encode, which is written directly with zlib rather than through PIL's encoder and
+its per-row filter search. Without NumPy, it falls back to composing each pair with PIL.
+
+Run this module directly to pre-render every matchup into the addon's image directory:
+
+    python artwork.py [--compress-level N] [out_dir]
+"""
+import os
+import os.path
+import json
+import time
+import zlib
+import struct
+import logging as log
+import fileutil
+import tracing
+
+# style: (logo subdirectory, margin, spacing, alpha)
+STYLES = {
+    'poster': ('scaled', 10, 20, 0.0),
+    'thumb': ('icons', 2, 4, 0.0),
+}
+BACKGROUND = int(0.5 * 255)
+# zlib level for PNG output; 0 stores images uncompressed, trading disk for encode time
+COMPRESS_LEVEL = 6
+BATCH_SIZE = 64  # Matchups per pre-rendering job
+
+_sprites = {}
+_halves = {}
+
+
+def sprite(logo_dir, subdir, code):
+    """Return the decoded logo for `code`, loading it from disk only on first use"""
+    key = (logo_dir, subdir, code)
+    if key not in _sprites:
+        from PIL import Image
+        img = Image.open(os.path.join(logo_dir, subdir, '{}.png'.format(code)))
+        img.load()
+        _sprites[key] = img
+    return _sprites[key]
+
+
+def compose(img_1, img_2, margin=0, spacing=0, alpha=0.):
+    from PIL import Image
+    width = img_1.size[0] + img_2.size[0] + 2 * margin + spacing
+    height = max(img_1.size[1], img_2.size[1]) + 2 * margin
+
+    s = BACKGROUND
+    new_img = Image.new('RGBA', (width, height), (s, s, s, int(alpha*255)))
+    new_img.paste(img_1, (margin,
+                          int((height - img_1.size[1])/2)), img_1)
+    new_img.paste(img_2, (margin + spacing + img_1.size[0],
+                          int((height - img_2.size[1])/2)), img_2)
+    return new_img
+
+
+def join_images(path_1, path_2, out_path, margin=0, spacing=0, alpha=0.):
+    from PIL import Image
+    compose(Image.open(path_1), Image.open(path_2), margin, spacing, alpha).save(out_path)
+
+
+def render(logo_dir, out_dir, home_code, away_code, style, compress_level=COMPRESS_LEVEL):
+    """Compose one matchup image into `out_dir`, returning its file name"""
+    subdir, margin, spacing, alpha = STYLES[style]
+    fname = '{}_{}_{}.png'.format(home_code, away_code, style)
+    with tracing.span('join images'):
+        img = compose(sprite(logo_dir, subdir, home_code), sprite(logo_dir, subdir, away_code),
+                      margin, spacing, alpha)
+        img.save(os.path.join(out_dir, fname), compress_level=compress_level)
+    return fname
+
+
+def _half(logo_dir, subdir, code, height, left, right, alpha):
+    """Return the RGBA array of one side of a matchup: a logo blended onto the background,
+    centred vertically in `height` rows with `left` and `right` columns of padding"""
+    key = (logo_dir, subdir, code, height, left, right, alpha)
+    if key not in _halves:
+        import numpy as np
+        logo = np.asarray(sprite(logo_dir, subdir, code).convert('RGBA'), dtype=np.uint16)
+        logo_height, logo_width = logo.shape[:2]
+        top = int((height - logo_height) / 2)
+
+        half = np.empty((height, left + logo_width + right, 4), dtype=np.uint16)
+        half[...] = (BACKGROUND, BACKGROUND, BACKGROUND, int(alpha*255))
+        region = half[top:top + logo_height, left:left + logo_width]
+        # Same blend as Image.paste with the logo as its own mask, all four channels included
+        mask = logo[:, :, 3:]
+        region[...] = (logo * mask + region * (255 - mask) + 127) // 255
+        _halves[key] = half.astype(np.uint8)
+    return _halves[key]
+
+
+def _png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+def write_png(path, pixels, compress_level=COMPRESS_LEVEL):
+    """Write an RGBA uint8 array as a PNG with no row filtering"""
+    import numpy as np
+    height, width = pixels.shape[:2]
+    rows = np.zeros((height, 1 + 4 * width), dtype=np.uint8)  # Leading 0: filter type None
+    rows[:, 1:] = pixels.reshape(height, 4 * width)
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)  # 8-bit RGBA
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header) +
+                _png_chunk(b'IDAT', zlib.compress(rows.tobytes(), compress_level)) +
+                _png_chunk(b'IEND', b''))
+
+
+def render_batch(logo_dir, out_dir, pairs, style, compress_level=COMPRESS_LEVEL):
+    """Compose the matchup image of each (home code, away code) in `pairs` into `out_dir`,
+    returning their file names"""
+    try:
+        import numpy as np
+    except ImportError:
+        return [render(logo_dir, out_dir, home_code, away_code, style, compress_level)
+                for home_code, away_code in pairs]
+
+    subdir, margin, spacing, alpha = STYLES[style]
+    fnames = []
+    for home_code, away_code in pairs:
+        fname = '{}_{}_{}.png'.format(home_code, away_code, style)
+        with tracing.span('join images'):
+            height = 2 * margin + max(sprite(logo_dir, subdir, home_code).size[1],
+                                      sprite(logo_dir, subdir, away_code).size[1])
+            pixels = np.concatenate(
+                (_half(logo_dir, subdir, home_code, height, margin, 0, alpha),
+                 _half(logo_dir, subdir, away_code, height, spacing, margin, alpha)), axis=1)
+            write_png(os.path.join(out_dir, fname), pixels, compress_level)
+        fnames.append(fname)
+    return fnames
+
+
+class ArtworkStore(object):
+    TOUCH_INTERVAL = 24 * 60 * 60  # Granularity of last-used times, to limit manifest writes
+    EVICT_TO = 0.9  # Fraction of the cap to evict down to, so eviction doesn't run every save
+
+    def __init__(self, store_dir, logo_dir, evictable=False):
+        self.store_dir = store_dir
+        self.logo_dir = logo_dir
+        self.evictable = evictable  # Pre-rendered sets shipped with the addon are kept whole
+        self.manifest_path = os.path.join(store_dir, 'manifest.json')
+        self._manifest = None
+        self._dirty = False
+
+    @property
+    def manifest(self):
+        """Maps each image key to [file name, size in bytes, last used time]"""
+        if self._manifest is None:
+            self._manifest = self._load()
+        return self._manifest
+
+    def _load(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            manifest = {}
+        # Manifests written before images were sized held bare file names
+        return {key: entry for key, entry in manifest.items() if isinstance(entry, list)}
+
+    def reload(self):
+        """Pick up changes other processes made to the manifest, dropping unsaved ones"""
+        self._manifest = None
+        self._dirty = False
+
+    def _merge(self):
+        """Fold in entries other processes saved since the manifest was loaded.
+
+        Keeps the latest last-used time of entries on both sides. Entries only held here are
+        kept if their image still exists, i.e. unless another process evicted it.
+        """
+        on_disk = self._load()
+        for key, entry in list(self.manifest.items()):
+            other = on_disk.get(key)
+            if other is not None:
+                entry[2] = max(entry[2], other[2])
+            elif not os.path.exists(os.path.join(self.store_dir, entry[0])):
+                del self.manifest[key]
+        for key, entry in on_disk.items():
+            self.manifest.setdefault(key, entry)
+
+    @staticmethod
+    def key(home_code, away_code, style):
+        return '{}_{}_{}'.format(home_code, away_code, style)
+
+    def path(self, home_code, away_code, style):
+        """Return the path of a matchup image, rendering it if it isn't in the store yet"""
+        key = self.key(home_code, away_code, style)
+        entry = self.manifest.get(key)
+        now = time.time()
+        if entry is None:
+            if not os.path.exists(self.store_dir):
+                os.makedirs(self.store_dir)
+            entry = _entry(self.store_dir, render(self.logo_dir, self.store_dir, home_code,
+                                                  away_code, style))
+            self.manifest[key] = entry
+            self._dirty = True
+        elif now - entry[2] > self.TOUCH_INTERVAL:
+            entry[2] = now
+            self._dirty = True
+        return os.path.join(self.store_dir, entry[0])
+
+    def update(self, entries):
+        self.manifest.update(entries)
+        self._dirty = True
+
+    def _evict(self, max_bytes):
+        total = sum(entry[1] for entry in self.manifest.values())
+        if total <= max_bytes:
+            return
+
+        for key, entry in sorted(self.manifest.items(), key=lambda kv: kv[1][2]):
+            try:
+                os.remove(os.path.join(self.store_dir, entry[0]))
+            except OSError:
+                pass
+            del self.manifest[key]
+            total -= entry[1]
+            if total <= max_bytes * self.EVICT_TO:
+                break
+
+    def save(self, max_bytes=None):
+        """Write the manifest, first evicting least recently used images over `max_bytes`"""
+        if not self._dirty:
+            return
+        self._merge()
+        if self.evictable and max_bytes:
+            self._evict(max_bytes)
+        fileutil.write_json(self.manifest_path, self.manifest)
+        self._dirty = False
+
+
+def _entry(store_dir, fname):
+    return [fname, os.path.getsize(os.path.join(store_dir, fname)), time.time()]
+
+
+def open_store(img_dir, profile_dir):
+    """Return the matchup set pre-rendered by this module if the addon ships one, or else
+    the evictable store in the profile dir"""
+    prebuilt_dir = os.path.join(img_dir, 'matchups')
+    logo_dir = os.path.join(img_dir, 'logos')
+    if os.path.exists(os.path.join(prebuilt_dir, 'manifest.json')):
+        return ArtworkStore(prebuilt_dir, logo_dir)
+    return ArtworkStore(os.path.join(profile_dir, 'artwork'), logo_dir, evictable=True)
+
+
+def precache(store, games, max_bytes=None):
+    """Make sure the store holds every image needed to list `games` (a list of mlb.Game)"""
+    store.reload()  # Long-lived callers would otherwise miss images rendered elsewhere
+    if not os.path.exists(store.store_dir):
+        os.makedirs(store.store_dir)
+    for style in STYLES:
+        pairs = [(g.home_file_code, g.away_file_code) for g in games
+                 if store.key(g.home_file_code, g.away_file_code, style) not in store.manifest]
+        if pairs:
+            store.update(_render_job((store.logo_dir, store.store_dir, pairs, style,
+                                      COMPRESS_LEVEL)))
+    store.save(max_bytes)
+
+
+def _render_job(args):
+    logo_dir, out_dir, pairs, style, compress_level = args
+    fnames = render_batch(logo_dir, out_dir, pairs, style, compress_level)
+    return [(ArtworkStore.key(home_code, away_code, style), _entry(out_dir, fname))
+            for (home_code, away_code), fname in zip(pairs, fnames)]
+
+
+def prerender(store, codes, processes=None, compress_level=COMPRESS_LEVEL):
+    """Render every ordered pair of `codes` in every style into `store` using a process pool"""
+    if not os.path.exists(store.store_dir):
+        os.makedirs(store.store_dir)
+
+    jobs = []
+    for style in STYLES:
+        pairs = [(home, away) for home in codes for away in codes
+                 if home != away and store.key(home, away, style) not in store.manifest]
+        jobs.extend((store.logo_dir, store.store_dir, pairs[i:i + BATCH_SIZE], style,
+                     compress_level) for i in range(0, len(pairs), BATCH_SIZE))
+    log.info("Rendering {} batches of matchup images".format(len(jobs)))
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        for entries in pool.imap_unordered(_render_job, jobs):
+            store.update(entries)
+    finally:
+        pool.close()
+        pool.join()
+    store.save()
+
+
+if __name__ == '__main__':
+    import argparse
+    from mlb import TEAM_CODES
+    log.basicConfig(level=log.INFO)
+
+    img_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'images')
+    parser = argparse.ArgumentParser(description="Pre-render every matchup image")
+    parser.add_argument('out_dir', nargs='?', default=os.path.join(img_dir, 'matchups'))
+    parser.add_argument('--compress-level', type=int, default=COMPRESS_LEVEL,
+                        help="PNG zlib level, 0 (stored) to 9")
+    args = parser.parse_args()
+
+    codes = sorted(set(code for _, code in TEAM_CODES.values()))
+    prerender(ArtworkStore(args.out_dir, os.path.join(img_dir, 'logos')), codes,
+              compress_level=args.compress_level)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Profile the addon's plugin modes offline.
+
+Runs main_menu and/or game through addon.py's own dispatch, against the local stand-in
+server and the stubbed xbmc modules, as a cold first invocation would, and writes a profile
+of each (see profiling.py):
+
+    python bench/hotspots.py [main_menu] [game] [--out DIR] [--top N] [--latency SECONDS]
+
+Feed the .collapsed files to flamegraph.pl or speedscope for a flame graph.
+"""
+import os
+import os.path
+import sys
+import runpy
+import logging
+import argparse
+import tempfile
+import shutil
+
+from run import REPO_DIR, DATE, setup_environment, Redirector  # Also puts the stubs on sys.path
+from server import StandInServer
+import profiling
+
+EVENT_ID = '14-447000-2016-06-01'
+
+
+def invoke(query):
+    """Run addon.py as Kodi would for a plugin URL with the given query string"""
+    def run(mlb, addon):
+        sys.argv = ['plugin://plugin.video.mlbtv/', '1', query]
+        root = logging.getLogger()
+        level, handlers = root.level, list(root.handlers)
+        try:
+            runpy.run_path(os.path.join(REPO_DIR, 'addon.py'), run_name='__main__')
+        finally:
+            # Undo the addon's log setup so it doesn't pile up across modes
+            root.setLevel(level)
+            root.handlers[:] = handlers
+    return run
+
+
+MODES = {
+    'main_menu': invoke('?mode=main_menu&date={}'.format(DATE)),
+    'game': invoke('?mode=game&event_id={}'.format(EVENT_ID)),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('modes', nargs='*', metavar='mode',
+                        help="one of {} (default: all)".format(', '.join(sorted(MODES))))
+    parser.add_argument('--out', default=os.path.join(REPO_DIR, 'profiles'))
+    parser.add_argument('--top', type=int, default=profiling.TOP_N)
+    parser.add_argument('--latency', type=float, default=0.,
+                        help="seconds of server latency per request")
+    args = parser.parse_args()
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error("unknown mode(s): {}".format(', '.join(sorted(unknown))))
+
+    logging.basicConfig(level=logging.ERROR)
+    root = tempfile.mkdtemp(prefix='mlbtv-profile-')
+    try:
+        server = StandInServer(args.latency).start()
+        mlb, addon = setup_environment(root)
+        Redirector(mlb.get_session(), server.base_url)
+
+        for mode in args.modes or sorted(MODES):
+            profiler = profiling.Profiler().start()
+            MODES[mode](mlb, addon)
+            profiler.stop()
+            path = profiler.write(args.out, mode, args.top)
+            print('{}: {:.1f} ms -> {}.{{prof,collapsed,txt}}'.format(
+                mode, profiler.elapsed * 1000, path))
+        server.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Offline benchmarks for the addon's listing and playback paths.
+
+Runs the real mlb/addon code against the local stand-in server and stubbed xbmc modules
+and reports wall time, allocations and HTTP requests per stage. Allocations are the
+tracemalloc peak where it exists; on Python 2 they are the rise in peak RSS and the net
+growth in live objects instead:
+
+    python bench/run.py [--repeat N] [--latency SECONDS] [--padding BYTES] [--scale N]
+"""
+import os
+import os.path
+import sys
+import time
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+import urlparse
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [os.path.join(BENCH_DIR, 'stubs'), REPO_DIR]
+
+import xbmc  # noqa: E402
+import xbmcaddon  # noqa: E402
+import profiling  # noqa: E402
+from server import StandInServer  # noqa: E402
+
+DATE = datetime.date(2016, 6, 1)
+SMIL_URL = ('http://mlbvod-akc.mlb.com/mlbam/2016/06/01/MLB_GAME_VIDEO_BOSNYY_HOME_20160601/'
+            'master_wired_web.smil')
+
+
+def make_addon_dir(root, team_codes):
+    """Build a throwaway addon directory holding placeholder logos and fanart"""
+    from PIL import Image
+
+    img_dir = os.path.join(root, 'resources', 'images')
+    for subdir, size in (('scaled', (150, 100)), ('icons', (40, 40))):
+        logo_dir = os.path.join(img_dir, 'logos', subdir)
+        os.makedirs(logo_dir)
+        for _, code in team_codes.values():
+            Image.new('RGBA', size, (200, 30, 30, 255)).save(
+                os.path.join(logo_dir, '{}.png'.format(code)))
+    os.makedirs(os.path.join(img_dir, 'fanart'))
+    Image.new('RGB', (320, 180)).save(os.path.join(img_dir, 'fanart', 'default.jpg'))
+
+
+def setup_environment(root):
+    """Point the xbmc stubs at temporary directories and import the addon modules"""
+    addon_dir = os.path.join(root, 'addon')
+    profile_dir = os.path.join(root, 'profile')
+    os.makedirs(profile_dir)
+    xbmcaddon.INFO.update(path=addon_dir, profile=profile_dir)
+    xbmcaddon.SETTINGS.update(email='bench@example.com', password='bench', debug='Off',
+                              bitrate='2500K', prefetch_days='0')
+    xbmc.SPECIAL_PATHS['special://temp'] = os.path.join(root, 'temp')
+    sys.argv = ['plugin://plugin.video.mlbtv/', '1', '?mode=main_menu']
+
+    import mlb
+    make_addon_dir(addon_dir, mlb.TEAM_CODES)
+
+    import addon
+    addon.log = logging.getLogger()
+    addon.addon = addon.Addon(sys.argv, 'movies')
+    return mlb, addon
+
+
+class Redirector(object):
+    """Routes every request made through a requests.Session to the stand-in server"""
+    def __init__(self, session, base_url):
+        import requests
+        base = urlparse.urlsplit(base_url)
+
+        class Adapter(requests.adapters.HTTPAdapter):
+            def send(self, request, **kwargs):
+                parts = urlparse.urlsplit(request.url)
+                request.url = urlparse.urlunsplit((base.scheme, base.netloc) + parts[2:])
+                return super(Adapter, self).send(request, **kwargs)
+
+        session.adapters.clear()
+        session.mount('http://', Adapter())
+        session.mount('https://', Adapter())
+
+        self.requests = 0
+        self.bytes = 0
+        session.hooks['response'].append(self._count)
+
+    def _count(self, resp, *args, **kwargs):
+        # Reading resp.content here would pull streamed bodies in before the code under test
+        # gets to them. The stand-in server always sends a Content-Length.
+        self.requests += 1
+        self.bytes += int(resp.headers.get('Content-Length') or 0)
+
+    def reset(self):
+        self.requests = self.bytes = 0
+
+
+def build_stages(mlb, addon, root):
+    ctx = {}
+
+    def clear(*paths):
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def reset_scoreboards():
+        clear(mlb.scoreboard_cache.cache_dir)
+
+    def reset_art():
+        clear(addon.art_store.store_dir)
+        os.makedirs(addon.art_store.store_dir)
+        addon.art_store._manifest = None
+        addon.art_store._dirty = False
+        addon.artwork._sprites.clear()
+
+    def reset_login():
+        mlb.get_cookie_jar().clear()
+        mlb.auth.invalidate()
+        reset_feeds()
+
+    def reset_feeds():
+        mlb.feed_cache.clear()
+
+    def reset_streams():
+        mlb.stream_cache.clear()
+
+    def get_game_video():
+        content = mlb.get_game_video('14-447000-2016-06-01')
+        ctx['content'] = content['video']['147'][0]
+
+    return [
+        ('get_games (cold)', reset_scoreboards, lambda: mlb.get_games(DATE)),
+        ('get_games (cached)', None, lambda: mlb.get_games(DATE)),
+        ('show_games (cold art)', reset_art, lambda: addon.show_games(DATE)),
+        ('show_games (warm art)', None, lambda: addon.show_games(DATE)),
+        ('get_game_video (login)', reset_login, get_game_video),
+        ('get_game_video', reset_feeds, get_game_video),
+        ('get_game_video (cached)', None, get_game_video),
+        ('get_game_url (cold)', reset_streams, lambda: mlb.get_game_url(*ctx['content'])),
+        ('get_game_url (cached)', None, lambda: mlb.get_game_url(*ctx['content'])),
+        ('get_smil', None, lambda: mlb.get_smil(SMIL_URL)),
+    ]
+
+
+def measure(func, redirector):
+    """Return the wall time, peak bytes, net new objects, requests and bytes in of `func`"""
+    redirector.reset()
+    objects = sum(profiling.count_objects().values())
+    if tracemalloc:
+        tracemalloc.start()
+    else:
+        rss = profiling.max_rss()
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    peak = None
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    elif rss is not None:
+        peak = profiling.max_rss() - rss  # Only rises when the stage sets a new high
+    new_objects = sum(profiling.count_objects().values()) - objects
+    return elapsed, peak, new_objects, redirector.requests, redirector.bytes
+
+
+def report(results):
+    header = '{:<26} {:>10} {:>10} {:>12} {:>10} {:>6} {:>10}'
+    peak_label = 'peak KiB' if tracemalloc else 'RSS +KiB'
+    print(header.format('stage', 'best ms', 'median ms', peak_label, 'new objs', 'reqs',
+                        'KiB in'))
+    for name, runs in results:
+        times = sorted(run[0] for run in runs)
+        peak = runs[0][1]
+        print(header.format(name, '{:.1f}'.format(times[0] * 1000),
+                            '{:.1f}'.format(times[len(times) // 2] * 1000),
+                            '{:.0f}'.format(peak / 1024.) if peak is not None else 'n/a',
+                            '{:+d}'.format(runs[0][2]), runs[0][3],
+                            '{:.1f}'.format(runs[0][4] / 1024.)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.,
+                        help="seconds of server latency per request")
+    parser.add_argument('--padding', type=int, default=0,
+                        help="bytes of whitespace appended to every response")
+    parser.add_argument('--scale', type=int, default=1,
+                        help="multiply the number of games on the scoreboard")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    root = tempfile.mkdtemp(prefix='mlbtv-bench-')
+    try:
+        server = StandInServer(args.latency, args.padding, args.scale).start()
+        mlb, addon = setup_environment(root)
+        redirector = Redirector(mlb.get_session(), server.base_url)
+
+        results = []
+        for name, setup, func in build_stages(mlb, addon, root):
+            runs = []
+            for _ in range(args.repeat):
+                if setup:
+                    setup()
+                runs.append(measure(func, redirector))
+            results.append((name, runs))
+        report(results)
+        server.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
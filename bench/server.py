@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Local stand-in for the MLB servers, serving the recorded responses in bench/fixtures"""
+import os
+import os.path
+import json
+import time
+import hashlib
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+        return f.read()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type, headers=()):
+        body += b' ' * self.server.padding  # Trailing whitespace is harmless in JSON and XML
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_modified(self):
+        self.send_response(304)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _route(self, form):
+        path = urlparse.urlsplit(self.path).path
+        self.server.hits[path] = self.server.hits.get(path, 0) + 1
+        time.sleep(self.server.latency)
+
+        if path.endswith('master_scoreboard.json'):
+            body = self.server.scoreboard
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                return self._not_modified()
+            self._send(body, 'application/json', [('ETag', etag)])
+        elif path.endswith('enterworkflow.do'):
+            self._send(b'<html></html>', 'text/html',
+                       [('Set-Cookie', 'ftmu=ZnRtdS1maXh0dXJl; Path=/')])
+        elif path.endswith('authenticate.do'):
+            self._send(b'<html></html>', 'text/html',
+                       [('Set-Cookie', 'ipid=123456789; Path=/'),
+                        ('Set-Cookie', 'fprt=ZmluZ2VycHJpbnQ=; Path=/')])
+        elif 'op-findUserVerifiedEvent' in path:
+            name = 'game_url.xml' if 'contentId' in form else 'verified_event.xml'
+            self._send(load_fixture(name), 'text/xml')
+        elif path.endswith('.smil'):
+            self._send(load_fixture('master_wired_web.smil'), 'application/smil')
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        self._route({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._route(urlparse.parse_qs(self.rfile.read(length)))
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Serves the fixtures on localhost with a fixed per-request latency and optional padding
+
+    `scale` repeats the scoreboard's games to simulate busier days.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0., padding=0, scale=1):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.latency = latency
+        self.padding = padding
+        self.hits = {}
+        self.scoreboard = self._scaled_scoreboard(scale)
+
+    @staticmethod
+    def _scaled_scoreboard(scale):
+        body = load_fixture('master_scoreboard.json')
+        if scale == 1:
+            return body
+        doc = json.loads(body)
+        doc['data']['games']['game'] *= scale
+        return json.dumps(doc).encode('utf-8')
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Measure cold startup of the plugin entry point.
+
+Each run imports addon.py in a fresh interpreter (with the xbmc stubs), the way Kodi does
+for every navigation, and reports the time taken and which heavy modules were pulled in:
+
+    python bench/startup.py [--repeat N]
+"""
+import os
+import os.path
+import sys
+import json
+import argparse
+import tempfile
+import shutil
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+HEAVY_MODULES = ('requests', 'PIL', 'cookielib', 'multiprocessing', 'BeautifulSoup')
+
+CHILD = '''
+import sys, time, json
+start = time.time()
+sys.path[:0] = {paths!r}
+import xbmc, xbmcaddon
+xbmcaddon.INFO.update(path={root!r}, profile={root!r})
+xbmc.SPECIAL_PATHS['special://temp'] = {root!r}
+sys.argv = ['plugin://plugin.video.mlbtv/', '1', '?mode=main_menu']
+import addon
+elapsed = time.time() - start
+print(json.dumps({{'elapsed': elapsed,
+                   'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='mlbtv-startup-')
+    try:
+        code = CHILD.format(paths=[os.path.join(BENCH_DIR, 'stubs'), REPO_DIR], root=root,
+                            heavy=HEAVY_MODULES)
+        runs = [json.loads(subprocess.check_output([sys.executable, '-c', code]))
+                for _ in range(args.repeat)]
+    finally:
+        shutil.rmtree(root)
+
+    times = sorted(run['elapsed'] for run in runs)
+    print('import addon: best {:.1f} ms, median {:.1f} ms'.format(
+        times[0] * 1000, times[len(times) // 2] * 1000))
+    print('heavy modules loaded: {}'.format(', '.join(runs[0]['heavy']) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
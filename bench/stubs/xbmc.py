@@ -0,0 +1,42 @@
+"""Minimal stand-in for Kodi's xbmc module, for running the addon outside Kodi"""
+import logging
+
+LOGDEBUG, LOGINFO, LOGNOTICE, LOGWARNING, LOGERROR, LOGSEVERE, LOGFATAL, LOGNONE = range(8)
+
+_LEVELS = {
+    LOGDEBUG: logging.DEBUG,
+    LOGINFO: logging.INFO,
+    LOGNOTICE: logging.INFO,
+    LOGWARNING: logging.WARNING,
+    LOGERROR: logging.ERROR,
+    LOGSEVERE: logging.CRITICAL,
+    LOGFATAL: logging.CRITICAL,
+}
+
+# Maps special:// roots to real directories; filled in by the harness
+SPECIAL_PATHS = {}
+
+# Kodi's log is separate from Python logging. addon.py's __main__ routes the root logger
+# into log(), so passing messages back up to the root would loop forever.
+_log = logging.getLogger('xbmc')
+_log.propagate = False
+_log.addHandler(logging.StreamHandler())
+
+
+def log(msg, level=LOGDEBUG):
+    _log.log(_LEVELS.get(level, logging.DEBUG), msg)
+
+
+def translatePath(path):
+    for prefix, real in SPECIAL_PATHS.items():
+        if path.startswith(prefix):
+            return real + path[len(prefix):]
+    return path
+
+
+class Monitor(object):
+    def abortRequested(self):
+        return True
+
+    def waitForAbort(self, timeout=None):
+        return True
@@ -0,0 +1,19 @@
+"""Minimal stand-in for Kodi's xbmcaddon module"""
+
+# Filled in by the harness
+INFO = {'id': 'plugin.video.mlbtv', 'path': '.', 'profile': '.'}
+SETTINGS = {}
+
+
+class Addon(object):
+    def __init__(self, id=None):
+        pass
+
+    def getAddonInfo(self, key):
+        return INFO[key]
+
+    def getSetting(self, key):
+        return SETTINGS.get(key, '')
+
+    def setSetting(self, key, value):
+        SETTINGS[key] = value
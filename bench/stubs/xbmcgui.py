@@ -0,0 +1,26 @@
+"""Minimal stand-in for Kodi's xbmcgui module"""
+
+# Index returned by Dialog.select; set by the harness
+SELECT_INDEX = 0
+
+
+class ListItem(object):
+    def __init__(self, label='', label2='', iconImage='', thumbnailImage='', path=''):
+        self.label = label
+        self.path = path
+        self.art = {}
+        self.properties = {}
+
+    def setArt(self, art):
+        self.art.update(art)
+
+    def setProperty(self, key, value):
+        self.properties[key] = value
+
+    def select(self, selected):
+        pass
+
+
+class Dialog(object):
+    def select(self, heading, options):
+        return SELECT_INDEX
@@ -0,0 +1,26 @@
+"""Minimal stand-in for Kodi's xbmcplugin module that records directory items"""
+import xbmcaddon
+
+items = []
+resolved = []
+
+
+def getSetting(handle, key):
+    return xbmcaddon.SETTINGS.get(key, '')
+
+
+def setContent(handle, content):
+    pass
+
+
+def addDirectoryItem(handle, url, listitem, isFolder=False, totalItems=0):
+    items.append((url, listitem, isFolder))
+    return True
+
+
+def endOfDirectory(handle, succeeded=True, updateListing=False, cacheToDisc=True):
+    pass
+
+
+def setResolvedUrl(handle, succeeded, listitem):
+    resolved.append((succeeded, listitem))
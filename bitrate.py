@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Rendition selection driven by measured download throughput.
+
+The addon's own HTTP transfers feed a persisted moving average of throughput. SMIL
+renditions are then picked as the best one that fits within a safety fraction of that
+estimate and the user's bitrate cap, with some hysteresis so the choice doesn't flap
+between neighbouring renditions from one playback to the next.
+"""
+import threading
+import fileutil
+
+
+def parse_bitrate(setting):
+    """Convert a setting like '2500K' to bits per second, or None if it's unset"""
+    if not setting:
+        return None
+    setting = setting.upper()
+    if setting.endswith('K'):
+        return int(setting[:-1]) * 1000
+    return int(setting)
+
+
+class BitrateSelector(object):
+    ALPHA = 0.3  # Weight of each new sample in the moving average
+    SAFETY = 0.7  # Fraction of the estimated throughput a rendition may use
+    HYSTERESIS = 0.15  # Extra headroom required before moving up from the last rendition
+    MIN_SAMPLE_BYTES = 32 * 1024  # Smaller transfers mostly measure latency
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self._json = fileutil.JsonState(state_path)
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._json.data
+
+    def _save(self):
+        self._json.save()
+
+    @property
+    def throughput(self):
+        """Estimated throughput in bits per second, or None before any samples"""
+        return self.state.get('throughput')
+
+    def add_sample(self, nbytes, seconds):
+        if nbytes < self.MIN_SAMPLE_BYTES or seconds <= 0:
+            return
+        sample = nbytes * 8 / seconds
+        with self._lock:
+            estimate = self.state.get('throughput')
+            if estimate is None:
+                estimate = sample
+            else:
+                estimate = self.ALPHA * sample + (1 - self.ALPHA) * estimate
+            self.state['throughput'] = estimate
+            self._save()
+
+    def select(self, bitrates, cap=None):
+        """Return the best of `bitrates` that fits the cap and the throughput estimate"""
+        budget = float('inf')
+        if self.throughput is not None:
+            budget = self.throughput * self.SAFETY
+
+        fitting = [b for b in bitrates if b <= min(budget, cap or budget)]
+        best = max(fitting) if fitting else min(bitrates)
+
+        last = self.state.get('last_bitrate')
+        if last in fitting and best > last and best * (1 + self.HYSTERESIS) > budget:
+            best = last  # Not enough headroom to justify moving up yet
+
+        with self._lock:
+            if best != last:
+                self.state['last_bitrate'] = best
+                self._save()
+        return best
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Cookie jar that only touches the disk when its contents actually change.
+
+Callers may call save() as often as they like; it is a no-op unless a cookie was added,
+changed or removed since the last write. Writes go to a temporary file that is then
+renamed over the old one, so an interrupted write never leaves a truncated jar behind.
+"""
+import atexit
+import cookielib
+import fileutil
+
+
+class CookieStore(cookielib.LWPCookieJar):
+    def __init__(self, filename):
+        cookielib.LWPCookieJar.__init__(self, filename)
+        self.dirty = False
+        atexit.register(self.save)
+
+    def load(self, *args, **kwargs):
+        cookielib.LWPCookieJar.load(self, *args, **kwargs)
+        self.dirty = False
+
+    def set_cookie(self, cookie):
+        existing = self._cookies.get(cookie.domain, {}).get(cookie.path, {}).get(cookie.name)
+        if existing is None or ((existing.value, existing.expires, existing.discard) !=
+                                (cookie.value, cookie.expires, cookie.discard)):
+            self.dirty = True
+        cookielib.LWPCookieJar.set_cookie(self, cookie)
+
+    # The clear methods only dirty the jar if they removed something: add_cookie_header calls
+    # clear_expired_cookies on every request.
+    def clear(self, *args):
+        count = len(self)
+        cookielib.LWPCookieJar.clear(self, *args)
+        self.dirty = self.dirty or len(self) != count
+
+    def clear_session_cookies(self):
+        count = len(self)
+        cookielib.LWPCookieJar.clear_session_cookies(self)
+        self.dirty = self.dirty or len(self) != count
+
+    def clear_expired_cookies(self):
+        count = len(self)
+        cookielib.LWPCookieJar.clear_expired_cookies(self)
+        self.dirty = self.dirty or len(self) != count
+
+    def save(self, filename=None, ignore_discard=True, ignore_expires=False):
+        # Session cookies are kept by default: the fingerprint cookie we set is one
+        if not self.dirty:
+            return
+        filename = filename or self.filename
+        tmp_path = filename + '.tmp'
+        cookielib.LWPCookieJar.save(self, tmp_path, ignore_discard, ignore_expires)
+        fileutil.replace(tmp_path, filename)
+        self.dirty = False
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Download manager for archived game feeds.
+
+Queued feeds are persisted in downloads.json in the profile dir. The downloader resolves
+each feed to its media URL, and then fetches the file as fixed-size byte ranges on a small
+thread pool. Each range is written straight to its offset in a preallocated .part file. The
+queue records which segments are complete, so an interrupted download picks up where it
+left off. All segments draw from one shared throughput budget, and a download is only
+started if its full size fits within the disk budget. Jobs that don't fit wait, without
+being probed again, until the budget or the space used by other downloads leaves room.
+
+Feeds are resolved through their SMIL to a single HTTP(S) rendition, chosen the same way
+as for playback. Feeds only served over RTMP, or whose URL turns out to be a playlist
+rather than a video, are marked failed. The resident service runs the downloader
+(optionally only overnight); the plugin lists the queue in its 'downloads' mode.
+"""
+import os
+import os.path
+import re
+import time
+import datetime
+import threading
+import logging as log
+import fileutil
+import mlb
+
+SEGMENT_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+WORKERS = 4
+OVERNIGHT_HOURS = (1, 7)  # Local hours [start, end) of the 'Overnight' download window
+FAVOURITE_DAYS = 7  # How far back to look for favourite-team archives
+
+QUEUED, WAITING, ACTIVE, DONE, FAILED = 'queued', 'waiting', 'active', 'done', 'failed'
+# Content types of manifests and error pages, which must never be saved as a video
+NON_MEDIA_TYPE_RE = re.compile(r'^text/|xml|smil|html|json|mpegurl', re.I)
+
+
+class DownloadQueue(object):
+    """Persisted list of download jobs, each a dict with at least an id, name and state"""
+    def __init__(self, path):
+        self.path = path
+        self._json = fileutil.JsonState(path, list)
+        self._lock = threading.Lock()
+
+    @property
+    def jobs(self):
+        return self._json.data
+
+    @staticmethod
+    def job_id(feed):
+        """Jobs are keyed by event id, content id and scenario, like cached stream URLs"""
+        return '{}|{}|{}'.format(feed[1], feed[2], feed[4])
+
+    def add(self, name, feed, fname):
+        """Queue a feed (a content tuple from mlb.get_game_video), unless it already is"""
+        job_id = self.job_id(feed)
+        with self._lock:
+            if any(job['id'] == job_id for job in self.jobs):
+                return False
+            self.jobs.append({'id': job_id, 'name': name, 'feed': list(feed), 'fname': fname,
+                              'state': QUEUED, 'added': time.time()})
+        self.save()
+        return True
+
+    def has_event(self, event_id):
+        """Whether a feed of the game `event_id` has been queued"""
+        return any(job['feed'][1] == event_id for job in self.jobs)
+
+    def used_bytes(self):
+        """Bytes on disk or reserved by downloads that have been started.
+
+        Finished downloads whose files have been deleted no longer count. Their jobs are
+        kept so that they aren't queued again.
+        """
+        return sum(job.get('size', 0) for job in self.jobs
+                   if job['state'] == ACTIVE or (job['state'] == DONE and
+                                                 os.path.exists(job['path'])))
+
+    def pending(self, max_bytes=None):
+        """Jobs to work on, in order. Jobs waiting for disk space are only included once
+        they fit within `max_bytes` alongside the downloads already started."""
+        used = self.used_bytes()
+        # Active jobs are ones interrupted mid-download; they resume first
+        return ([job for job in self.jobs if job['state'] == ACTIVE] +
+                [job for job in self.jobs if job['state'] == WAITING and
+                 (not max_bytes or used + job['size'] <= max_bytes)] +
+                [job for job in self.jobs if job['state'] == QUEUED])
+
+    def save(self):
+        with self._lock:
+            self._json.save()
+
+
+def progress(job):
+    """Fraction of a job's bytes downloaded so far"""
+    segments = job.get('segments')
+    if job['state'] == DONE:
+        return 1.
+    if not segments:
+        return 0.
+    return sum(segments) / float(len(segments))
+
+
+class Throttle(object):
+    """Token bucket limiting the combined throughput of every segment worker"""
+    def __init__(self, rate):
+        self.rate = rate  # Bytes per second, or None for no limit
+        self._allowance = 0.
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= nbytes
+            delay = -self._allowance / self.rate if self._allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class Stopped(Exception):
+    """The downloader was asked to stop mid-download"""
+
+
+class Expired(Exception):
+    """The server rejected a job's signed media URL, which has to be resolved again"""
+
+
+class Truncated(IOError):
+    """A segment's response ended before all of its bytes arrived"""
+
+
+class Downloader(object):
+    def __init__(self, queue, download_dir, session, resolve, max_bytes=None, rate=None,
+                 workers=WORKERS, segment_size=SEGMENT_SIZE):
+        self.queue = queue
+        self.download_dir = download_dir
+        self.session = session
+        self.resolve = resolve  # Content tuple -> media URL
+        self.max_bytes = max_bytes
+        self.throttle = Throttle(rate)
+        self.workers = workers
+        self.segment_size = segment_size
+
+    def run(self, should_stop=lambda: False):
+        """Work through the queue until it is empty or `should_stop` returns True"""
+        for job in self.queue.pending(self.max_bytes):
+            if should_stop():
+                return
+            try:
+                self.download(job, should_stop)
+            except Stopped:
+                return
+            except Expired:
+                log.info("Media URL of {} expired; retrying next run".format(job['name']))
+                job['url'] = None
+            except Truncated as e:
+                log.info("{}; retrying next run".format(e))
+            except Exception as e:
+                log.exception("Download of {} failed".format(job['name']))
+                job['state'] = FAILED
+                job['error'] = str(e)
+            self.queue.save()
+
+    def _probe(self, job):
+        if not job.get('url'):
+            job['url'] = self.resolve(job['feed'])
+        if not re.match(r'https?://', job['url']):
+            raise ValueError("Only HTTP feeds can be downloaded")
+        resp = self.session.head(job['url'], allow_redirects=True)
+        resp.raise_for_status()
+        size = int(resp.headers.get('Content-Length') or 0)
+        if not size:
+            raise ValueError("Server did not report a size")
+        content_type = resp.headers.get('Content-Type') or ''
+        if NON_MEDIA_TYPE_RE.search(content_type):
+            raise ValueError("URL is not a video ({})".format(content_type))
+        ranged = resp.headers.get('Accept-Ranges') == 'bytes'
+        job['size'] = size
+        job['segments'] = [False] * (-(-size // self.segment_size) if ranged else 1)
+
+    def download(self, job, should_stop):
+        if job['state'] in (QUEUED, WAITING):
+            if job['state'] == QUEUED:
+                self._probe(job)
+            if self.max_bytes and self.queue.used_bytes() + job['size'] > self.max_bytes:
+                log.info("Not starting {}: over the disk budget".format(job['name']))
+                job['state'] = WAITING
+                job['error'] = "Waiting for disk space"
+                return
+            job['state'] = ACTIVE
+            job.pop('error', None)
+            self.queue.save()
+        elif not job.get('url'):
+            job['url'] = self.resolve(job['feed'])
+
+        if not os.path.exists(self.download_dir):
+            os.makedirs(self.download_dir)
+        path = os.path.join(self.download_dir, job['fname'])
+        part_path = path + '.part'
+        if not os.path.exists(part_path):
+            job['segments'] = [False] * len(job['segments'])  # Start over if it was deleted
+            with open(part_path, 'wb') as f:
+                f.truncate(job['size'])
+
+        pending = [i for i, done in enumerate(job['segments']) if not done]
+        log.info("Downloading {}: {} of {} segments left".format(
+            job['name'], len(pending), len(job['segments'])))
+
+        def fetch(index):
+            if should_stop():
+                raise Stopped()
+            self._fetch_segment(job, index, part_path, should_stop)
+            job['segments'][index] = True
+            self.queue.save()
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.workers, len(pending)) or 1)
+        try:
+            pool.map(fetch, pending)
+        finally:
+            pool.close()
+            pool.join()
+
+        os.rename(part_path, path)
+        job['state'] = DONE
+        job['path'] = path
+
+    def _fetch_segment(self, job, index, part_path, should_stop):
+        start = index * self.segment_size
+        end = job['size'] - 1
+        headers = {}
+        if len(job['segments']) > 1:
+            end = min(start + self.segment_size, job['size']) - 1
+            headers['Range'] = 'bytes={}-{}'.format(start, end)
+
+        resp = self.session.get(job['url'], headers=headers, stream=True)
+        try:
+            if resp.status_code in (401, 403, 410):
+                raise Expired()
+            resp.raise_for_status()
+            if headers and resp.status_code != 206:
+                raise ValueError("Server ignored the byte range")
+            written = 0
+            with open(part_path, 'r+b') as f:
+                f.seek(start)
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    if should_stop():
+                        raise Stopped()
+                    self.throttle.consume(len(chunk))
+                    f.write(chunk)
+                    written += len(chunk)
+            # A dropped connection can end the body early without an error, which would
+            # otherwise leave the rest of the segment as preallocated zeros
+            if written != end - start + 1:
+                raise Truncated("Segment {} of {} ended after {} of {} bytes".format(
+                    index, job['name'], written, end - start + 1))
+        finally:
+            resp.close()
+
+
+download_queue = DownloadQueue(os.path.join(mlb.profile_dir, 'downloads.json'))
+
+
+def download_dir():
+    return mlb.get_settings().get('download_dir') or os.path.join(mlb.profile_dir, 'downloads')
+
+
+def in_window(now=None):
+    """Whether downloads may run now, according to the 'download_hours' setting"""
+    if mlb.get_settings().get('download_hours') != 'Overnight':
+        return True
+    hour = (now or datetime.datetime.now()).hour
+    return OVERNIGHT_HOURS[0] <= hour < OVERNIGHT_HOURS[1]
+
+
+def queue_game(event_id, name):
+    """Queue the archived video feed of a game, preferring a favourite team's coverage.
+
+    Returns whether a new download was queued.
+    """
+    if download_queue.has_event(event_id):
+        return False  # Already queued; skip the MediaService round trip
+    content = mlb.get_game_video(event_id)
+    fav_team_ids = mlb.get_settings()['fav_team_ids']
+    feeds = sorted(content['video'].items(), key=lambda kv: kv[0] not in fav_team_ids)
+    for coverage_id, tups in feeds:
+        for tup in tups:
+            if not tup[5]:  # Archived rather than live
+                fname = re.sub(r'[^\w.-]+', '_', '{}_{}.mp4'.format(name, tup[0]))
+                return download_queue.add('{} ({})'.format(name, tup[0]), tup, fname)
+    return False
+
+
+def queue_favourites(days=FAVOURITE_DAYS):
+    """Queue the archives of favourite teams' finished games over the last `days` days,
+    returning how many were newly queued"""
+    fav_team_ids = set(mlb.get_settings()['fav_team_ids'])
+    today = datetime.date.today()
+    dates = [today - datetime.timedelta(n) for n in range(days)]
+    queued = 0
+    for date, games in sorted(mlb.get_games_range(dates).items()):
+        for g in games or []:
+            if (g.status == 'Final' and g.event_id and
+                    (g.home_team_id in fav_team_ids or g.away_team_id in fav_team_ids)):
+                name = '{} {} at {}'.format(date, g.away_team_name, g.home_team_name)
+                try:
+                    queued += queue_game(g.event_id, name)
+                except Exception:
+                    log.exception("Failed to queue {}".format(name))
+    return queued
+
+
+def list_downloads():
+    return download_queue.jobs
+
+
+def budget_bytes():
+    """The disk budget for downloads from the 'download_budget_gb' setting, or None"""
+    budget_gb = float(mlb.get_settings().get('download_budget_gb') or 0)
+    return int(budget_gb * 1024 ** 3) or None
+
+
+def run_downloads(should_stop=lambda: False):
+    rate_kbps = int(mlb.get_settings().get('download_rate_kbps') or 0)
+    downloader = Downloader(download_queue, download_dir(), mlb.get_session(),
+                            lambda feed: mlb.resolve_download_url(*feed),
+                            max_bytes=budget_bytes(), rate=rate_kbps * 1000 // 8 or None)
+    downloader.run(should_stop)
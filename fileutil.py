@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Crash-safe file writes shared by the addon's persisted state.
+
+Files are written to a temporary sibling and then renamed over the original, so readers in
+other processes see either the old contents or the new ones, never a partial file.
+JsonState wraps this for the small JSON documents (caches, login state, the download
+queue) that are loaded on first use and rewritten on every change.
+"""
+import os
+import json
+
+
+def replace(src, dst):
+    """Rename `src` over `dst`"""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows can't rename over an existing file. This falls back to remove-then-rename,
+        # which leaves a brief window where `dst` doesn't exist.
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def write_json(path, obj):
+    """Atomically replace the file at `path` with `obj` encoded as JSON"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    replace(tmp_path, path)
+
+
+class JsonState(object):
+    """A JSON document at `path`, loaded on first use and saved atomically.
+
+    `default` is called for the initial value when the file is missing or unreadable.
+    """
+    def __init__(self, path, default=dict):
+        self.path = path
+        self.default = default
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except (IOError, ValueError):
+                self._data = self.default()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def reload(self):
+        """Forget the loaded copy, so the next access reads the file again"""
+        self._data = None
+
+    def save(self):
+        write_json(self.path, self.data)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Single-pass parsers for MediaService and SMIL responses.
+
+The documents are read with iterparse, and each element is discarded as soon as the
+fields we need have been pulled out of it, so large multi-feed responses never sit in
+memory as a full tree.
+"""
+from collections import namedtuple
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+MediaItem = namedtuple('MediaItem', 'url state auth_status')
+VerifiedContent = namedtuple('VerifiedContent', 'type content_id state attributes media_items')
+VerifiedEvent = namedtuple('VerifiedEvent',
+                           'status_code session_key event_id updated_fingerprint contents')
+SmilVideo = namedtuple('SmilVideo', 'src bitrate')
+Smil = namedtuple('Smil', 'base videos')
+
+
+def _local(tag):
+    """Strip any namespace from an element tag"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_verified_event(source):
+    """Parse a findUserVerifiedEvent response from the file-like `source`"""
+    top = {}  # First occurrence of each top-level field
+    contents = []
+    content = media_item = None
+    stack = []
+
+    for event, el in ET.iterparse(source, events=('start', 'end')):
+        tag = _local(el.tag)
+        if event == 'start':
+            stack.append(tag)
+            if tag == 'user-verified-content':
+                content = {'attributes': {}, 'media_items': []}
+            elif tag == 'user-verified-media-item' and content is not None:
+                media_item = {}
+            continue
+
+        stack.pop()
+        parent = stack[-1] if stack else None
+        text = el.text.strip() if el.text else None
+
+        if content is not None and tag == 'domain-attribute':
+            content['attributes'].setdefault(el.get('name'), text or '')
+        elif media_item is not None:
+            if tag == 'user-verified-media-item':
+                content['media_items'].append(MediaItem(media_item.get('url'),
+                                                        media_item.get('state'),
+                                                        media_item.get('auth-status')))
+                media_item = None
+            elif parent == 'auth-status':
+                media_item.setdefault('auth-status', tag)
+            elif tag in ('url', 'state'):
+                media_item.setdefault(tag, text)
+        elif content is not None:
+            if tag == 'user-verified-content':
+                contents.append(VerifiedContent(content.get('type'), content.get('content-id'),
+                                                content.get('state'),
+                                                content['attributes'],
+                                                content['media_items']))
+                content = None
+                el.clear()
+            elif tag in ('type', 'content-id', 'state'):
+                content.setdefault(tag, text)
+        elif tag in ('status-code', 'session-key', 'event-id', 'updated-fingerprint'):
+            top.setdefault(tag, text)
+
+    return VerifiedEvent(top.get('status-code'), top.get('session-key'), top.get('event-id'),
+                         top.get('updated-fingerprint'), contents)
+
+
+def parse_smil(source):
+    """Parse a SMIL playlist from the file-like `source`"""
+    base = None
+    videos = []
+    for _, el in ET.iterparse(source):
+        tag = _local(el.tag)
+        if tag == 'meta' and base is None:
+            base = el.get('base')
+        elif tag == 'video':
+            videos.append(SmilVideo(el.get('src'), int(el.get('system-bitrate', 0))))
+        el.clear()
+    return Smil(base, videos)
@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
 # Copyright 2016 Nate Bogdanowicz
-import sys
+import io
 import os
 import os.path
+import re
 import json
+import time
 import urllib
-import cookielib
+import urlparse
 import logging as log
+import datetime
+import threading
 from collections import defaultdict
-import requests
-from BeautifulSoup import BeautifulStoneSoup
+import fileutil
+import mediaservice
+import scoreboard
+import schedule
+import bitrate
+import tracing
 
 TEAM_CODES = {
     '109': ('Arizona Diamondbacks', 'ari'),
@@ -54,6 +62,14 @@ SOAP_CODES = {
     "-3500": "Sign-on Restriction Error",
     "-4000": "System Error",
 }
+AUTH_ERROR = "-2000"
+
+
+class SoapError(Exception):
+    """A MediaService request returned a non-OK status code"""
+    def __init__(self, code):
+        super(SoapError, self).__init__(SOAP_CODES.get(code, 'Unknown error'))
+        self.code = code
 
 
 def get_profile_dir():
@@ -69,19 +85,24 @@ def get_profile_dir():
 
 
 def load_settings():
+    # Read through xbmcaddon rather than the plugin handle so the service can use it too
     settings = {}
     try:
-        import xbmcplugin
-        handle = int(sys.argv[1])
+        import xbmcaddon
+        addon = xbmcaddon.Addon()
     except ImportError:
         return settings
 
-    for key in ('email', 'password', 'debug', 'bitrate'):
-        settings[key] = xbmcplugin.getSetting(handle, key)
+    for key in ('email', 'password', 'debug', 'bitrate', 'prefetch_days', 'trace_file',
+                'incremental_refresh', 'stream_scoreboard', 'eager_resolve', 'timeout',
+                'retries', 'compression', 'artwork_cache_mb', 'prefetch_feeds', 'download_dir',
+                'download_budget_gb', 'download_rate_kbps', 'download_hours',
+                'auto_download_favourites', 'profile_next'):
+        settings[key] = addon.getSetting(key)
 
     teams = []
     for code in TEAM_CODES:
-        if xbmcplugin.getSetting(handle, code) == 'true':
+        if addon.getSetting(code) == 'true':
             teams.append(code)
     settings['fav_team_ids'] = teams
 
@@ -89,45 +110,576 @@ def load_settings():
 
 
 profile_dir, addon_dir = get_profile_dir()
-settings = load_settings()
-cookie_path = os.path.join(profile_dir, 'cookie_file')
-cookie_jar = cookielib.LWPCookieJar(cookie_path)
-if os.path.exists(cookie_path):
-    cookie_jar.load()
-
 if not os.path.exists(profile_dir):
     os.makedirs(profile_dir)
+cookie_path = os.path.join(profile_dir, 'cookie_file')
 
 DEFAULT_HEADERS = {
     'User-agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:19.0) Gecko/20100101 Firefox/19.0'
 }
-sess = requests.Session()
-sess.cookies = cookie_jar
-sess.headers.update(DEFAULT_HEADERS)
+PREFETCH_WORKERS = 4
+
+# Settings, cookies and the HTTP session are created on first use, so that plugin
+# invocations which never touch the network don't pay for importing requests or reading
+# every setting.
+_settings = None
+_cookie_jar = None
+_sess = None
+_init_lock = threading.Lock()
+
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        _settings = load_settings()
+    return _settings
+
+
+def reset_settings():
+    """Forget the loaded settings and the session built from them, so both are reloaded"""
+    global _settings, _sess
+    with _init_lock:
+        _settings = None
+        _sess = None
+
+
+def artwork_cache_bytes():
+    """Size cap of the rendered artwork store in bytes"""
+    return int(get_settings().get('artwork_cache_mb') or 50) * 1024 * 1024
+
+
+def get_cookie_jar():
+    global _cookie_jar
+    with _init_lock:
+        if _cookie_jar is None:
+            import cookiestore
+            jar = cookiestore.CookieStore(cookie_path)
+            if os.path.exists(cookie_path):
+                jar.load()
+            tracing.instrument(jar, 'save', 'save cookies')
+            _cookie_jar = jar
+    return _cookie_jar
+
+
+def get_session():
+    global _sess
+    cookie_jar = get_cookie_jar()
+    with _init_lock:
+        if _sess is None:
+            import transport
+            settings = get_settings()
+            sess = transport.build_session(
+                pool_size=PREFETCH_WORKERS,
+                timeout=int(settings.get('timeout') or 10),
+                retries=int(settings.get('retries') or 0),
+                compression=settings.get('compression') != 'false')
+            sess.cookies = cookie_jar
+            sess.headers.update(DEFAULT_HEADERS)
+            tracing.instrument(sess, 'request', _request_span_name)
+            _sess = sess
+    return _sess
+
+
+def _request_span_name(method, url, *args, **kwargs):
+    parts = urlparse.urlsplit(url)
+    return '{} {}/{}'.format(method, parts.netloc, parts.path.rsplit('/', 1)[-1])
+
+
+def enable_tracing():
+    """Turn on timing spans, including for every HTTP request and cookie jar save.
+
+    Must be called before the session or cookie jar are first used.
+    """
+    tracing.enable()
+
+
+def save_cookies():
+    """Write any pending cookie changes, without loading the jar if it was never used"""
+    if _cookie_jar is not None:
+        _cookie_jar.save()
 
 
 def log_cookies(message="Cookies:"):
+    if not log.getLogger().isEnabledFor(log.DEBUG):
+        return
     lines = [message]
-    for cookie in cookie_jar:
+    for cookie in get_cookie_jar():
         lines.append("  {}: {}".format(cookie.name, cookie.value))
-    log.info("\n".join(lines))
+    log.debug("\n".join(lines))
+
+
+class Game(object):
+    """The fields of a scoreboard game that the addon uses.
+
+    Scoreboard games are projected into these as soon as they are parsed, so the full
+    JSON tree (linescores, pitchers, links, ...) can be dropped straight away.
+    """
+    __slots__ = ('game_id', 'event_id', 'status', 'inning', 'top_inning', 'home_runs',
+                 'away_runs', 'home_team_id', 'away_team_id', 'home_team_name',
+                 'away_team_name', 'home_file_code', 'away_file_code', 'time', 'start_minute')
+    # Scoreboard fields read by from_json
+    JSON_FIELDS = ('id', 'game_media', 'status', 'linescore', 'time', 'ampm', 'home_team_id',
+                   'away_team_id', 'home_team_name', 'away_team_name', 'home_file_code',
+                   'away_file_code')
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_json(cls, g):
+        media = g.get('game_media', {}).get('media', {})
+        if isinstance(media, list):
+            media = media[0] if media else {}
+
+        status = g.get('status', {})
+        runs = (g.get('linescore') or {}).get('r', {})
+        hour_str, min_str = g['time'].split(':')
+        is_pm = g['ampm'].lower() == 'pm'
+        start_minute = (int(hour_str) % 12 + 12*int(is_pm)) * 60 + int(min_str)
+
+        return cls(g['id'], media.get('calendar_event_id'), status.get('status'),
+                   status.get('inning', ''), status.get('top_inning', ''), runs.get('home', ''),
+                   runs.get('away', ''), g['home_team_id'], g['away_team_id'],
+                   g['home_team_name'], g['away_team_name'], g['home_file_code'],
+                   g['away_file_code'], g['time'] + ' ' + g['ampm'], start_minute)
+
+    def to_list(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    @property
+    def category(self):
+        """The status the listing groups this game under"""
+        return 'Pre-Game' if self.status == 'Preview' else self.status
+
+    @property
+    def state(self):
+        """Everything about the game that changes while it is being played"""
+        return [self.status, self.inning, self.top_inning, self.home_runs, self.away_runs]
+
+
+class ScoreboardCache(object):
+    """On-disk cache of scoreboard game lists, one JSON file per date.
+
+    Days whose games have all reached a terminal status never change again and are kept
+    indefinitely; days with live games expire quickly. Stale entries keep their ETag and
+    Last-Modified values so they can be revalidated instead of downloaded again.
+    """
+    TERMINAL_STATUSES = ('Final', 'Postponed', 'Cancelled', 'Completed Early')
+    LIVE_STATUSES = ('In Progress', 'Warmup', 'Delayed', 'Delayed Start', 'Manager Challenge')
+    LIVE_TTL = 60
+    PENDING_TTL = 15 * 60
+    VERSION = 2
+
+    def __init__(self, cache_dir, max_entries=60):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._entries = {}  # Decoded entries, which the resident service keeps between calls
+
+    def _path(self, date):
+        return os.path.join(self.cache_dir, date.strftime('%Y-%m-%d.json'))
+
+    def load(self, date):
+        path = self._path(date)
+        entry = self._entries.get(date)
+        if entry is None:
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (IOError, ValueError):
+                return None
+            if entry.get('version') != self.VERSION:
+                return None
+            entry['games'] = [Game(*values) for values in entry['games']]
+            self._entries[date] = entry
+        try:
+            os.utime(path, None)  # Mark as recently used for eviction
+        except OSError:
+            pass
+        return entry
+
+    def is_fresh(self, entry):
+        if entry['ttl'] is None:
+            return True
+        return time.time() - entry['fetched'] < entry['ttl']
+
+    def ttl(self, games):
+        statuses = set(g.status for g in games)
+        if statuses and statuses.issubset(self.TERMINAL_STATUSES):
+            return None
+        if statuses.intersection(self.LIVE_STATUSES):
+            return self.LIVE_TTL
+        return self.PENDING_TTL
+
+    def revalidated(self, date, entry):
+        """Restart the TTL of an entry the server confirmed is unchanged"""
+        entry['fetched'] = time.time()
+        fileutil.write_json(self._path(date),
+                            dict(entry, games=[g.to_list() for g in entry['games']]))
+
+    def store(self, date, games, etag=None, last_modified=None):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        entry = {
+            'version': self.VERSION,
+            'games': [g.to_list() for g in games],
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched': time.time(),
+            'ttl': self.ttl(games),
+        }
+        fileutil.write_json(self._path(date), entry)
+        self._entries[date] = dict(entry, games=games)
+        self._evict()
+
+    def _evict(self):
+        paths = [os.path.join(self.cache_dir, fname) for fname in os.listdir(self.cache_dir)
+                 if fname.endswith('.json')]
+        if len(paths) <= self.max_entries:
+            return
+        paths.sort(key=os.path.getmtime)
+        evicted = set(paths[:len(paths) - self.max_entries])
+        for path in evicted:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # Already evicted by a concurrent fetch
+        for date in list(self._entries):
+            if self._path(date) in evicted:
+                del self._entries[date]
+
+
+scoreboard_cache = ScoreboardCache(os.path.join(profile_dir, 'scoreboards'))
+bitrate_selector = bitrate.BitrateSelector(os.path.join(profile_dir, 'throughput.json'))
+
+
+schedule_index = schedule.ScheduleIndex(os.path.join(profile_dir, 'schedule.db'))
+
+
+def _record_throughput(resp, transfer_time):
+    """Feed a finished transfer into the throughput estimate.
+
+    Bytes are counted as received on the wire, before any gzip decoding, since that is what
+    a stream will have to sustain.
+    """
+    try:
+        nbytes = resp.raw.tell()
+    except AttributeError:
+        nbytes = len(resp.content)
+    bitrate_selector.add_sample(nbytes, transfer_time)
+
+
+def _body_time(resp, started):
+    """Time spent downloading the body of a fully read response, excluding time to first byte"""
+    return time.time() - started - resp.elapsed.total_seconds()
 
 
 def get_games(date):
+    return _fetch_games(date)
+
+
+def get_games_range(dates, max_workers=PREFETCH_WORKERS):
+    """Fetch the scoreboards for several dates concurrently, returning a dict keyed by date.
+
+    Dates that fail to load map to None rather than aborting the whole batch.
+    """
+    if not dates:
+        return {}
+
+    def fetch(date):
+        try:
+            return _fetch_games(date)
+        except Exception:
+            log.exception("Failed to fetch games for {}".format(date))
+            return None
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(max_workers, len(dates)))
+    try:
+        results = pool.map(fetch, dates)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(dates, results))
+
+
+def prefetch_games(date, days):
+    """Warm the scoreboard cache for the `days` days on either side of `date` in the background.
+
+    Returns the started thread so the caller can join it before exiting.
+    """
+    dates = [date + datetime.timedelta(n) for n in range(-days, days + 1) if n != 0]
+    thread = threading.Thread(target=get_games_range, args=(dates,))
+    thread.start()
+    return thread
+
+
+def get_team_games(team_id, days=14):
+    """Return (date, Game) pairs for a team's games over the last `days` days, newest first.
+
+    Answers from the schedule index, fetching only the scoreboards of dates it hasn't
+    settled (plus today's, whose statuses are still changing).
+    """
+    today = datetime.date.today()
+    dates = [today - datetime.timedelta(n) for n in range(days)]
+    missing = schedule_index.missing_dates(dates[1:])
+    for date, games in get_games_range([today] + missing).items():
+        # Dates answered from the scoreboard cache weren't indexed when they were fetched
+        if games is not None:
+            _index_games(date, games)
+    return [(date, Game(*values))
+            for date, values in schedule_index.team_games(team_id, since=dates[-1])]
+
+
+def _fetch_games(date):
+    entry = scoreboard_cache.load(date)
+    if entry is not None and scoreboard_cache.is_fresh(entry):
+        return entry['games']
+
+    headers = {}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
     url = date.strftime('http://mlb.mlb.com/gdcross/components/game/mlb/year_%Y/month_%m/day_%d/'
                         'master_scoreboard.json')
-    resp = sess.get(url)
+    stream = get_settings().get('stream_scoreboard') != 'false'
+    started = time.time()
+    resp = get_session().get(url, headers=headers, stream=stream)
     log_cookies()
-    games = json.loads(resp.text)['data']['games']['game']
 
-    cookie_jar.save()
+    if resp.status_code == 304 and entry is not None:
+        scoreboard_cache.revalidated(date, entry)
+        return entry['games']
+    if resp.status_code != 200:
+        # Error pages would otherwise parse as a day without games, and be cached and indexed
+        resp.raise_for_status()
+        raise IOError("Unexpected status {} for {}".format(resp.status_code, url))
+
+    if stream:
+        transfer_time = [0.]
+
+        def timed(chunks):
+            # Only time the reads, not the parsing interleaved with them
+            chunks = iter(chunks)
+            while True:
+                read_start = time.time()
+                chunk = next(chunks, None)
+                transfer_time[0] += time.time() - read_start
+                if chunk is None:
+                    return
+                yield chunk
+
+        with tracing.span('parse scoreboard'):
+            chunks = timed(resp.iter_content(16 * 1024))
+            games = [Game.from_json(g) for g in scoreboard.iter_games(chunks, Game.JSON_FIELDS)]
+            for _ in chunks:
+                pass  # Drain the tail so the connection goes back to the pool
+        _record_throughput(resp, transfer_time[0])
+    else:
+        _record_throughput(resp, _body_time(resp, started))
+        with tracing.span('parse scoreboard'):
+            games = json.loads(resp.text)['data']['games']['game']
+            if isinstance(games, dict):
+                games = [games]  # Single-game days aren't wrapped in a list
+            games = [Game.from_json(g) for g in games]
+
+    scoreboard_cache.store(date, games, resp.headers.get('ETag'),
+                           resp.headers.get('Last-Modified'))
+    _index_games(date, games)
     return games
 
 
+def _index_games(date, games):
+    # Days without games are only settled once they're over
+    settled = (scoreboard_cache.ttl(games) is None or
+               (not games and date < datetime.date.today()))
+    schedule_index.add(date, games, settled)
+
+
+class Auth(object):
+    """Tracks the validity of the MLB.tv login so playback only hits the login flow when needed.
+
+    The session key returned by findUserVerifiedEvent is persisted with an expiry, and the
+    identity cookies (ipid, fprt) are trusted until they expire or the service rejects them.
+    """
+    SESSION_TTL = 60 * 60
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self._json = fileutil.JsonState(state_path)
+        # Held around logins so concurrent callers (service threads, prefetches) log in once
+        self._lock = threading.RLock()
+
+    @property
+    def state(self):
+        return self._json.data
+
+    def _save(self):
+        self._json.save()
+
+    @staticmethod
+    def _cookie(name):
+        for cookie in get_cookie_jar():
+            if cookie.name == name and not cookie.is_expired():
+                return cookie
+        return None
+
+    def has_identity(self):
+        return self._cookie('ipid') is not None and self._cookie('fprt') is not None
+
+    def session_key(self):
+        """Return a session key, logging in or refreshing the session only if needed"""
+        with self._lock:
+            state = self.state
+            if (self.has_identity() and state.get('session_key') and
+                    state.get('expires', 0) > time.time()):
+                log.info("Reusing cached session key")
+                return state['session_key']
+
+            login()
+            ftmu = self._cookie('ftmu')
+            session_key = urllib.unquote(ftmu.value) if ftmu else None
+            self.update(session_key)  # So callers waiting on the lock reuse this login
+            return session_key
+
+    def update(self, session_key):
+        """Record a session key handed back by the MediaService"""
+        if not session_key:
+            return
+        with self._lock:
+            state = self.state
+            if (state.get('session_key') != session_key or
+                    state.get('expires', 0) <= time.time()):
+                state['session_key'] = session_key
+                state['expires'] = time.time() + self.SESSION_TTL
+                self._save()
+
+    def invalidate(self):
+        """Forget the session and identity cookies, forcing a full login next time"""
+        log.info("Invalidating login")
+        with self._lock:
+            self._json.data = {}
+            self._save()
+        cookie_jar = get_cookie_jar()
+        for cookie in list(cookie_jar):
+            if cookie.name in ('ipid', 'fprt', 'ftmu'):
+                cookie_jar.clear(cookie.domain, cookie.path, cookie.name)
+        cookie_jar.save()
+        feed_cache.clear()  # Cached feeds carry the old session key
+
+
+auth = Auth(os.path.join(profile_dir, 'auth.json'))
+
+
+class ExpiringCache(object):
+    """JSON-backed dict of entries that each carry an 'expires' time.
+
+    Expired entries are pruned whenever a new one is added. Threads in the resident service
+    share the caches, so every change happens under a lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._json = fileutil.JsonState(path)
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self):
+        return self._json.data
+
+    def _put(self, key, entry):
+        now = time.time()
+        with self._lock:
+            for old_key, old_entry in list(self.entries.items()):
+                if old_entry['expires'] <= now:
+                    del self.entries[old_key]
+            self.entries[key] = entry
+            self._json.save()
+
+    def clear(self):
+        with self._lock:
+            self._json.data = {}
+            self._json.save()
+
+
+class FeedCache(ExpiringCache):
+    """Verified feed listings from get_game_video, keyed by event id.
+
+    Entries only live for TTL seconds: feeds come and go as games start and end, and each
+    listing carries the session key it was verified with.
+    """
+    TTL = 3 * 60
+
+    def get(self, event_id):
+        entry = self.entries.get(event_id)
+        if entry is None or entry['expires'] <= time.time():
+            return None
+        return entry['content']
+
+    def put(self, event_id, content):
+        self._put(event_id, {'content': content, 'expires': time.time() + self.TTL})
+
+
+feed_cache = FeedCache(os.path.join(profile_dir, 'feeds.json'))
+
+
 def get_game_video(event_id):
-    login()
-    cookies = {c.name: c.value for c in cookie_jar}
-    session = urllib.unquote(cookies['ftmu']) if 'ftmu' in cookies else None
+    content = feed_cache.get(event_id)
+    if content is not None:
+        log.info("Using cached feeds for {}".format(event_id))
+        return content
+    return _fetch_game_video(event_id)
+
+
+def prefetch_game_videos(event_ids, max_workers=PREFETCH_WORKERS):
+    """Verify the feed listings of several games in the background, caching each of them.
+
+    Returns the started thread so the caller can join it before exiting.
+    """
+    def fetch(event_id):
+        try:
+            _fetch_game_video(event_id)
+        except Exception:
+            log.exception("Failed to prefetch feeds for {}".format(event_id))
+
+    def run():
+        pending = [event_id for event_id in event_ids if feed_cache.get(event_id) is None]
+        if not pending:
+            return
+        fetch(pending[0])  # Logs in if needed, so the rest can share the session
+        if len(pending) == 1:
+            return
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(max_workers, len(pending) - 1))
+        try:
+            pool.map(fetch, pending[1:])
+        finally:
+            pool.close()
+            pool.join()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def _fetch_game_video(event_id):
+    try:
+        content = _get_game_video(event_id)
+    except SoapError as e:
+        if e.code != AUTH_ERROR:
+            raise
+        auth.invalidate()
+        content = _get_game_video(event_id)
+    feed_cache.put(event_id, content)
+    return content
+
+
+def _get_game_video(event_id):
+    session = auth.session_key()
+    cookies = {c.name: c.value for c in get_cookie_jar()}
 
     data = {
         'eventId': event_id,
@@ -142,26 +694,22 @@ def get_game_video(event_id):
         'User-agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:19.0) Gecko/20100101 Firefox/19.0',
         'Referer': 'http://mlb.mlb.com/shared/flash/mediaplayer/v4.4/R8/MediaPlayer4.swf?'
     }
-    resp = sess.post(url, data, headers=headers)
-    soup = BeautifulStoneSoup(resp.text)
-    status = soup.find('status-code').string
+    resp = get_session().post(url, data, headers=headers)
+    with tracing.span('parse MediaService'):
+        event = mediaservice.parse_verified_event(io.BytesIO(resp.content))
+    status = event.status_code
 
     if status != '1':
-        raise Exception(SOAP_CODES.get(status, 'Unknown error'))
+        raise SoapError(status)
 
     log_cookies("After findUserVerifiedEvent")
-    session_key = soup.find('session-key')
-    session = session_key.string if session_key else None
-    event_id = soup.find('event-id').string
-    items = soup.findAll('user-verified-content')
+    session = event.session_key or session
+    auth.update(event.session_key)
+    event_id = event.event_id
     verified_content = {'video': defaultdict(list), 'audio': defaultdict(list)}
 
-    def attr(item, name):
-        l = item('domain-attribute', attrs={'name': name})
-        return l[0].string if l else ''
-
-    for item in items:
-        state = item.state.string
+    for item in event.contents:
+        state = item.state
         if state == 'MEDIA_ARCHIVE':
             if int(event_id.split('-')[2]) < 2012:
                 raise NotImplementedError("Pre-2012 archived content")
@@ -173,14 +721,14 @@ def get_game_video(event_id):
         else:
             scenario = 'FMS_CLOUD'
             live = True
-        content_id = item('content-id')[0].string
+        content_id = item.content_id
 
         # TODO: handle blackout
 
-        call_letters = attr(item, 'call_letters')
-        home_team_id = attr(item, 'home_team_id')
-        away_team_id = attr(item, 'away_team_id')
-        coverage_team_id = attr(item, 'coverage_association')
+        call_letters = item.attributes.get('call_letters', '')
+        home_team_id = item.attributes.get('home_team_id', '')
+        away_team_id = item.attributes.get('away_team_id', '')
+        coverage_team_id = item.attributes.get('coverage_association', '')
 
         if home_team_id == coverage_team_id:
             coverage = TEAM_CODES[home_team_id][0] + ' Coverage'
@@ -191,7 +739,7 @@ def get_game_video(event_id):
 
         name = '{} - {}'.format(coverage, call_letters).replace('.', '').strip()
 
-        if item.type.string == 'audio':
+        if item.type == 'audio':
             name += ' Gameday Audio'
             scenario = 'AUDIO_FMS_32K'
             verified_content['audio'][coverage_team_id].append((name, event_id, content_id,
@@ -203,9 +751,155 @@ def get_game_video(event_id):
     return verified_content
 
 
+class StreamCache(ExpiringCache):
+    """Resolved playback URLs keyed by (event id, content id, scenario).
+
+    Entries expire with the signature on the underlying media URL (or after DEFAULT_TTL if
+    it carries none) and are dropped as soon as the fingerprint cookie they were resolved
+    with is rotated.
+    """
+    DEFAULT_TTL = 10 * 60
+    EXPIRY_MARGIN = 60
+    EXPIRY_RE = re.compile(r'(?:^|[?&~;=])(?:e|exp|expires)=(\d{9,})')
+
+    @staticmethod
+    def key(event, content, scenario):
+        return '{}|{}|{}'.format(event, content, scenario)
+
+    def expiry(self, media_url):
+        """Return the time at which a signed media URL stops being valid"""
+        query = media_url.split('?', 1)[1] if '?' in media_url else ''
+        match = self.EXPIRY_RE.search(query)
+        if match:
+            return int(match.group(1)) - self.EXPIRY_MARGIN
+        return time.time() + self.DEFAULT_TTL
+
+    def get(self, event, content, scenario, fingerprint):
+        key = self.key(event, content, scenario)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry['fingerprint'] != fingerprint or entry['expires'] <= time.time():
+                del self.entries[key]
+                self._json.save()
+                return None
+            return entry['url']
+
+    def put(self, event, content, scenario, fingerprint, url, media_url):
+        self._put(self.key(event, content, scenario), {
+            'url': url,
+            'fingerprint': fingerprint,
+            'expires': self.expiry(media_url),
+        })
+
+
+stream_cache = StreamCache(os.path.join(profile_dir, 'streams.json'))
+
+
+def resolve_download_url(name, event, content, session, scenario, live):
+    """Resolve a feed into the HTTP URL of one of its renditions, for downloading.
+
+    The rendition is chosen from the feed's SMIL the same way as for playback. Raises
+    ValueError for feeds that are only served over RTMP.
+
+    Downloads run long after their feeds were queued, so the session key stored with the
+    feed is ignored in favour of a current one.
+    """
+    def find():
+        cookies = {c.name: c.value for c in get_cookie_jar()}
+        return _find_game_url(event, content, auth.session_key(), scenario, cookies,
+                              _set_fingerprint)
+    try:
+        verified_event, game_url = find()
+    except SoapError as e:
+        if e.code != AUTH_ERROR:
+            raise
+        verified_event, game_url = find()  # _find_game_url invalidated the login
+    if game_url.startswith('rtmp'):
+        raise ValueError("Feed is only available over RTMP")
+    base, src = get_smil(game_url.split('?')[0])
+    if base and not re.match(r'https?://', base):
+        raise ValueError("Feed is only available over RTMP")
+    media_url = urlparse.urljoin(base or game_url, src)
+    if '?' in game_url:  # Carry the signed token over to the rendition
+        media_url += ('&' if '?' in media_url else '?') + game_url.split('?', 1)[1]
+    log.info("Download url for {}: {}".format(name, media_url))
+    return media_url
+
+
 def get_game_url(name, event, content, session, scenario, live):
+    cookies = {c.name: c.value for c in get_cookie_jar()}
+    cached_url = stream_cache.get(event, content, scenario, cookies.get('fprt'))
+    if cached_url:
+        log.info('Using cached url for {}'.format(name))
+        return cached_url
+
+    final_url, game_url = _resolve_game_url(name, event, content, session, scenario, live,
+                                            cookies, _set_fingerprint)
+    stream_cache.put(event, content, scenario, cookies['fprt'], final_url, game_url)
+    return final_url
+
+
+def resolve_game_urls(content_tups, max_workers=PREFETCH_WORKERS):
+    """Resolve the playback URLs of several feeds concurrently, caching each of them.
+
+    Every request starts from the current fingerprint. The last updated fingerprint handed
+    back is applied once at the end, and all resolved URLs are cached against it.
+    """
+    cookies = {c.name: c.value for c in get_cookie_jar()}
+    pending = [tup for tup in content_tups
+               if not stream_cache.get(tup[1], tup[2], tup[4], cookies.get('fprt'))]
+    if not pending:
+        return
+
+    fingerprints = []
+
+    def resolve(tup):
+        try:
+            return _resolve_game_url(*tup, cookies=dict(cookies),
+                                     on_fingerprint=fingerprints.append)
+        except Exception:
+            log.exception("Failed to resolve {}".format(tup[0]))
+            return None
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(max_workers, len(pending)))
+    try:
+        results = pool.map(resolve, pending)
+    finally:
+        pool.close()
+        pool.join()
+
+    fingerprint = cookies['fprt']
+    if fingerprints:
+        fingerprint = fingerprints[-1]
+        _set_fingerprint(fingerprint)
+    for tup, result in zip(pending, results):
+        if result:
+            final_url, game_url = result
+            stream_cache.put(tup[1], tup[2], tup[4], fingerprint, final_url, game_url)
+
+
+def _set_fingerprint(new_fprt):
+    import cookielib
+    cookie_jar = get_cookie_jar()
+    new_cookie = cookielib.Cookie(
+        version=0, name='fprt', value=new_fprt, port=None, port_specified=False,
+        domain='.mlb.com', domain_specified=False, domain_initial_dot=False,
+        path='/', path_specified=True, secure=False, expires=None, discard=True,
+        comment=None, comment_url=None, rest={'HttpOnly': None}, rfc2109=False)
+    cookie_jar.set_cookie(new_cookie)
+    cookie_jar.save()
+
+
+def _find_game_url(event, content, session, scenario, cookies, on_fingerprint):
+    """Ask the MediaService for a feed's media URL, returning it with the verified event.
+
+    `on_fingerprint` is called with any updated fingerprint the service hands back, and
+    `cookies` is updated to match.
+    """
     url = 'https://secure.mlb.com/pubajaxws/bamrest/MediaService2_0/op-findUserVerifiedEvent/v-2.3?'
-    cookies = {c.name: c.value for c in cookie_jar}
     data = {
         'subject': 'LIVE_EVENT_COVERAGE',
         'sessionKey': session,
@@ -216,41 +910,44 @@ def get_game_url(name, event, content, session, scenario, live):
         'fingerprint': cookies['fprt'],
         'platform': 'WEB_MEDIAPLAYER'
     }
-    resp = sess.post(url, data)
-    soup = BeautifulStoneSoup(resp.text, convertEntities=BeautifulStoneSoup.XML_ENTITIES)
-    try:
-        new_fprt = soup.find('updated-fingerprint').string
-        if new_fprt:
-            new_cookie = cookielib.Cookie(
-                version=0, name='fprt', value=new_fprt, port=None, port_specified=False,
-                domain='.mlb.com', domain_specified=False, domain_initial_dot=False,
-                path='/', path_specified=True, secure=False, expires=None, discard=True,
-                comment=None, comment_url=None, rest={'HttpOnly': None}, rfc2109=False)
-            cookie_jar.set_cookie(new_cookie)
-            cookie_jar.save(ignore_discard=True, ignore_expires=True)
-            cookies['fprt'] = new_fprt
-    except AttributeError:
+    resp = get_session().post(url, data)
+    with tracing.span('parse MediaService'):
+        verified_event = mediaservice.parse_verified_event(io.BytesIO(resp.content))
+    new_fprt = verified_event.updated_fingerprint
+    if new_fprt:
+        on_fingerprint(new_fprt)
+        cookies['fprt'] = new_fprt
+    else:
         log.info('No New Fingerprint')
 
-    status = soup.find('status-code').string
+    status = verified_event.status_code
     if status != "1":
-        raise Exception(SOAP_CODES.get(status, 'Unknown error'))
+        if status == AUTH_ERROR:
+            auth.invalidate()
+        raise SoapError(status)
 
-    if soup.find('state').string == 'MEDIA_OFF':
+    verified = verified_event.contents[0] if verified_event.contents else None
+    if verified and verified.state == 'MEDIA_OFF':
         raise Exception('Status : Media Off')  # Could check for preview
 
     # TODO: Deal with blackouts
 
-    if 'notauthorizedstatus' in str(soup.find('auth-status')):
+    media_item = verified.media_items[0] if verified and verified.media_items else None
+    if media_item and media_item.auth_status == 'notauthorizedstatus':
         raise Exception('Status : Not Authorized')  # Could check for preview
 
-    try:
-        game_url = (soup.findAll('user-verified-content')[0]
-                    ('user-verified-media-item')[0]('url')[0].string)
-    except:
+    if not media_item or not media_item.url:
         raise Exception('game_url not found')
+    game_url = media_item.url
 
     log.info("game_url: {}".format(game_url))
+    return verified_event, game_url
+
+
+def _resolve_game_url(name, event, content, session, scenario, live, cookies, on_fingerprint):
+    """Resolve a feed into its final RTMP string, returning it along with the media URL"""
+    verified_event, game_url = _find_game_url(event, content, session, scenario, cookies,
+                                              on_fingerprint)
 
     if game_url.startswith('rtmp'):
         if 'live/' in game_url:
@@ -274,11 +971,11 @@ def get_game_url(name, event, content, session, scenario, live):
         pageurl = ('pageUrl=http://mlb.mlb.com/shared/flash/mediaplayer/v4.4/R8/MP4.jsp?calendar_'
                    'event_id={}&content_id={}&media_id=&view_key=&media_type=audio&source=MLB&spo'
                    'nsor=MLB&clickOrigin=Media+Grid&affiliateId=Media+Grid&feed_code='
-                   'h&team=mlb'.format(soup.find('event-id').string, content))
+                   'h&team=mlb'.format(verified_event.event_id, content))
     else:
         pageurl = ('pageUrl=http://mlb.mlb.com/shared/flash/mediaplayer/v4.4/R8/MP4.jsp?calendar_'
                    'event_id={}&content_id=&media_id=&view_key=&media_type=video&source=MLB&spons'
-                   'or=MLB&clickOrigin=&affiliateId=&team=mlb'.format(soup.find('event-id').string))
+                   'or=MLB&clickOrigin=&affiliateId=&team=mlb'.format(verified_event.event_id))
     swfurl = 'swfUrl=http://mlb.mlb.com/shared/flash/mediaplayer/v4.4/R8/MediaPlayer4.swf swfVfy=1'
     if live:
         swfurl += ' live=1'
@@ -286,10 +983,13 @@ def get_game_url(name, event, content, session, scenario, live):
 
     log.info('Name: {}'.format(name))
     log.info('Final url: {}'.format(final_url))
-    return final_url
+    return final_url, game_url
 
 
 def login():
+    sess = get_session()
+    cookie_jar = get_cookie_jar()
+    settings = get_settings()
     cookies = {c.name: c.value for c in cookie_jar}
     if 'ipid' in cookies and 'fprt' in cookies:
         log.info("Already logged in, getting session cookie")
@@ -309,23 +1009,31 @@ def login():
         }
         sess.post('https://secure.mlb.com/authenticate.do', data)
         log_cookies()
+
     cookie_jar.save()
 
 
 def get_smil(url):
-    resp = sess.get(url)
-    soup = BeautifulStoneSoup(resp.text)
-    # user_bitrate = '2400K'.replace('K', '000')  # TODO: Make this a setting
-    log.info(soup('video'))
-    best_el = max(soup('video'), key=lambda el: int(el['system-bitrate']))
-    return soup.meta['base'], best_el['src']
+    started = time.time()
+    resp = get_session().get(url)
+    _record_throughput(resp, _body_time(resp, started))
+    with tracing.span('parse SMIL'):
+        smil = mediaservice.parse_smil(io.BytesIO(resp.content))
+    log.info(smil.videos)
+
+    cap = bitrate.parse_bitrate(get_settings().get('bitrate'))
+    chosen = bitrate_selector.select([video.bitrate for video in smil.videos], cap)
+    log.info('Chose {} bps (cap {}, estimated throughput {})'.format(
+        chosen, cap, bitrate_selector.throughput))
+    best = next(video for video in smil.videos if video.bitrate == chosen)
+    return smil.base, best.src
 
 
 if __name__ == '__main__':
     # REPL test code
     log.basicConfig(level=log.INFO)
-    games = get_games()
-    event_id = games[0]['game_media']['media'][0]['calendar_event_id']
+    games = get_games(datetime.date.today())
+    event_id = games[0].event_id
     content = get_game_video(event_id)
     print(content)
-    url = get_game_url(*content['video'][1])
+    url = get_game_url(*list(content['video'].values())[0][0])
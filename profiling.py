@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Whole-invocation profiling: deterministic call stats, sampled stacks and allocations.
+
+A Profiler runs cProfile over the thread that started it while a background thread samples
+the stacks of every thread. On stop, write() leaves three files behind:
+
+    <name>.prof       cProfile stats, for pstats or snakeviz
+    <name>.collapsed  sampled stacks in collapsed form, for flamegraph.pl or speedscope
+    <name>.txt        top functions by cumulative time, and the top allocation sites
+                      (from tracemalloc) or, on Python 2, object growth by type and the
+                      rise in peak RSS
+
+The addon starts one for a single invocation when the 'Profile Next Invocation' setting is
+on; bench/hotspots.py drives one offline against the recorded fixtures.
+"""
+import os
+import os.path
+import gc
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+SAMPLE_INTERVAL = 0.005
+TOP_N = 25
+
+
+def count_objects():
+    """Count live objects by type name. Only containers are tracked by the garbage collector,
+    so this undercounts strings, numbers and (on Python 2.7) dicts of atomic values."""
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def max_rss():
+    """Peak resident set size of this process in bytes, or None where it can't be read"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024  # Linux reports KiB
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+class Profiler(object):
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self.elapsed = None
+        self.snapshot = None
+        self.object_growth = None  # Used instead of snapshot where tracemalloc is missing
+        self.rss_growth = None
+        self._objects = None
+        self._rss = None
+        self._profile = cProfile.Profile()
+        self._stopped = threading.Event()
+        self._sampler = None
+        self._started = None
+
+    def start(self):
+        if tracemalloc:
+            tracemalloc.start()
+        else:
+            self._objects = count_objects()
+            self._rss = max_rss()
+        self._started = time.time()
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+        self._profile.enable()
+        return self
+
+    def stop(self):
+        self._profile.disable()
+        self._stopped.set()
+        self._sampler.join()
+        self.elapsed = time.time() - self._started
+        if tracemalloc:
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        else:
+            self.object_growth = count_objects() - self._objects
+            if self._rss is not None:
+                self.rss_growth = max_rss() - self._rss
+
+    def _sample(self):
+        own_id = threading.current_thread().ident
+        while not self._stopped.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, 'thread-{}'.format(thread_id)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Return the sampled stacks as 'frame;frame;... count' lines"""
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(self.samples.items()))
+
+    def report(self, top=TOP_N):
+        out = StringIO()
+        out.write('Wall time: {:.1f} ms, {} stack samples\n\n'.format(
+            self.elapsed * 1000, sum(self.samples.values())))
+        stats = pstats.Stats(self._profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(top)
+
+        if self.snapshot is not None:
+            out.write('Top {} allocation sites:\n'.format(top))
+            for stat in self.snapshot.statistics('lineno')[:top]:
+                out.write('  {}\n'.format(stat))
+        else:
+            if self.rss_growth is not None:
+                out.write('Peak RSS grew by {:.0f} KiB\n\n'.format(self.rss_growth / 1024.))
+            out.write('Top {} types by growth in gc-tracked objects (no tracemalloc):\n'
+                      .format(top))
+            for name, count in self.object_growth.most_common(top):
+                out.write('  {:>8} {}\n'.format('+{}'.format(count), name))
+        return out.getvalue()
+
+    def write(self, out_dir, name, top=TOP_N):
+        """Write name.prof, name.collapsed and name.txt into `out_dir`, returning their base
+        path"""
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        base = os.path.join(out_dir, name)
+        self._profile.dump_stats(base + '.prof')
+        with open(base + '.collapsed', 'w') as f:
+            f.write(self.collapsed())
+        with open(base + '.txt', 'w') as f:
+            f.write(self.report(top))
+        return base
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Local channel between the plugin and the resident background service.
+
+Kodi runs every plugin invocation in a fresh interpreter, so the HTTP session, cookies and
+decoded scoreboards would otherwise be rebuilt on each navigation. The service keeps them
+in memory and answers the plugin over a loopback TCP socket: one JSON request line, one
+JSON response line. The port and a random token are published in the profile dir; only
+processes that can read the profile may make calls.
+
+The plugin goes through call(), which falls back to running the function in-process when
+the service isn't running (or is running a different version of the addon).
+"""
+import os
+import json
+import socket
+import binascii
+import datetime
+import threading
+import logging as log
+import SocketServer
+import mlb
+import downloads
+import fileutil
+import tracing
+
+PROTOCOL_VERSION = 1
+CONNECT_TIMEOUT = 0.5
+CALL_TIMEOUT = 60
+# Calls that may make many round trips: a cold team schedule fetches up to 14 scoreboards
+SLOW_CALL_TIMEOUT = 300
+SLOW_METHODS = frozenset(['get_team_games', 'queue_favourites'])
+ENDPOINT_PATH = os.path.join(mlb.profile_dir, 'service.json')
+
+
+class Unavailable(Exception):
+    """The resident service isn't running or can't be reached"""
+
+
+class RemoteError(Exception):
+    """A call raised an exception inside the resident service"""
+
+
+def _parse_date(date_str):
+    return datetime.date(*(int(n) for n in date_str.split('-')))
+
+
+def _games_out(games):
+    return [g.to_list() for g in games]
+
+
+def _games_in(rows):
+    return [mlb.Game(*values) for values in rows]
+
+
+def _identity(value):
+    return value
+
+
+# name: (function, argument decoders, result encoder, result decoder)
+METHODS = {
+    'get_games': (mlb.get_games, (_parse_date,), _games_out, _games_in),
+    'get_team_games': (
+        mlb.get_team_games, (_identity,),
+        lambda pairs: [(str(date), g.to_list()) for date, g in pairs],
+        lambda rows: [(_parse_date(date), mlb.Game(*values)) for date, values in rows]),
+    # The service outlives prefetch threads, so remote callers get nothing to join
+    'prefetch_games': (mlb.prefetch_games, (_parse_date, _identity), lambda thread: None,
+                       _identity),
+    'get_game_video': (mlb.get_game_video, (_identity,), _identity, _identity),
+    'prefetch_game_videos': (mlb.prefetch_game_videos, (_identity,), lambda thread: None,
+                             _identity),
+    'resolve_game_urls': (mlb.resolve_game_urls, (_identity,), _identity, _identity),
+    'get_game_url': (mlb.get_game_url, (_identity,) * 6, _identity, _identity),
+    # The service owns the download queue while it runs, so changes go through it
+    'queue_favourites': (downloads.queue_favourites, (), _identity, _identity),
+    'list_downloads': (downloads.list_downloads, (), _identity, _identity),
+}
+
+
+def _encode_arg(arg):
+    return str(arg) if isinstance(arg, datetime.date) else arg
+
+
+def call(method, *args):
+    """Run mlb.`method` in the resident service, or in this process if it can't be reached"""
+    try:
+        with tracing.span('ipc ' + method):
+            return _call(method, *args)
+    except Unavailable as e:
+        log.debug("Resident service unavailable ({}); calling {} directly".format(e, method))
+    return METHODS[method][0](*args)
+
+
+def _call(method, *args):
+    try:
+        with open(ENDPOINT_PATH) as f:
+            endpoint = json.load(f)
+    except (IOError, ValueError):
+        raise Unavailable('not running')
+    if endpoint.get('version') != PROTOCOL_VERSION:
+        raise Unavailable('protocol version mismatch')
+
+    try:
+        sock = socket.create_connection(('127.0.0.1', endpoint['port']), CONNECT_TIMEOUT)
+    except socket.error as e:
+        raise Unavailable(str(e))
+    timeout = SLOW_CALL_TIMEOUT if method in SLOW_METHODS else CALL_TIMEOUT
+    try:
+        sock.settimeout(timeout)
+        request = {'token': endpoint['token'], 'method': method,
+                   'args': [_encode_arg(arg) for arg in args]}
+        sock.sendall(json.dumps(request) + '\n')
+        line = sock.makefile('rb').readline()
+    except socket.timeout:
+        raise RemoteError('{} timed out after {} seconds'.format(method, timeout))
+    except socket.error as e:
+        raise RemoteError('{} failed: {}'.format(method, e))
+    finally:
+        sock.close()
+
+    if not line:
+        raise RemoteError('connection closed by the service')
+    response = json.loads(line)
+    if 'error' in response:
+        raise RemoteError(response['error'])
+    return METHODS[method][3](response['result'])
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        if request.get('token') != self.server.token or request.get('method') not in METHODS:
+            return  # Drop the connection; the client sees it as a remote error
+
+        func, decoders, encode, decode = METHODS[request['method']]
+        try:
+            args = [decoder(arg) for decoder, arg in zip(decoders, request['args'])]
+            response = {'result': encode(func(*args))}
+        except Exception as e:
+            log.exception("Resident call {} failed".format(request['method']))
+            response = {'error': '{}: {}'.format(type(e).__name__, e)}
+        mlb.save_cookies()
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class ResidentServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.token = binascii.hexlify(os.urandom(16))
+
+    def publish(self):
+        """Write the endpoint file that clients read to find the server"""
+        endpoint = {'version': PROTOCOL_VERSION, 'port': self.server_address[1],
+                    'token': self.token}
+        fileutil.write_json(ENDPOINT_PATH, endpoint)
+
+    def start(self):
+        """Serve from a background thread and advertise the endpoint"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.publish()
+        return thread
+
+    def stop(self):
+        try:
+            os.remove(ENDPOINT_PATH)
+        except OSError:
+            pass
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Local index of every game seen on a scoreboard, for browsing by team.
+
+Each scoreboard fetch adds its games to a small SQLite database keyed by event id and
+indexed on (team id, date), so a team's recent games can be listed with a single query
+instead of walking the scoreboards one day at a time. Only dates whose games have all
+finished are settled; the rest keep being refetched so their statuses stay current.
+"""
+import json
+import sqlite3
+import datetime
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS games (
+    game_id TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    home_team_id TEXT NOT NULL,
+    away_team_id TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS games_home ON games (home_team_id, date);
+CREATE INDEX IF NOT EXISTS games_away ON games (away_team_id, date);
+CREATE TABLE IF NOT EXISTS settled_dates (
+    date TEXT PRIMARY KEY
+);
+'''
+
+
+class ScheduleIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self._initialized = False
+
+    def _connect(self):
+        # One connection per call keeps the index safe to update from prefetch threads
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            conn.executescript(SCHEMA)
+            self._initialized = True
+        return conn
+
+    def add(self, date, games, settled):
+        """Record the games of a scoreboard (a list of mlb.Game) for `date`, which is
+        `settled` once none of them can change any more"""
+        date_str = date.strftime('%Y-%m-%d')
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?)',
+                    [(g.game_id, date_str, g.home_team_id, g.away_team_id,
+                      json.dumps(g.to_list())) for g in games])
+                if settled:
+                    conn.execute('INSERT OR IGNORE INTO settled_dates VALUES (?)', (date_str,))
+                else:
+                    conn.execute('DELETE FROM settled_dates WHERE date = ?', (date_str,))
+        finally:
+            conn.close()
+
+    def missing_dates(self, dates):
+        """Return those of `dates` that aren't settled: never indexed, or with games that
+        were still pending or live when last indexed"""
+        conn = self._connect()
+        try:
+            settled = set(row[0] for row in conn.execute('SELECT date FROM settled_dates'))
+        finally:
+            conn.close()
+        return [date for date in dates if date.strftime('%Y-%m-%d') not in settled]
+
+    def team_games(self, team_id, since=None):
+        """Return (date, game record values) for a team's indexed games, newest first"""
+        since_str = since.strftime('%Y-%m-%d') if since else ''
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT date, record FROM games WHERE home_team_id = ? AND date >= ? '
+                'UNION ALL '
+                'SELECT date, record FROM games WHERE away_team_id = ? AND date >= ? '
+                'ORDER BY date DESC', (team_id, since_str, team_id, since_str)).fetchall()
+        finally:
+            conn.close()
+        return [(datetime.date(*(int(n) for n in date_str.split('-'))), json.loads(record))
+                for date_str, record in rows]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Incremental extraction of games from master_scoreboard.json.
+
+Rather than decoding the whole document, the response body is read chunk by chunk and each
+element of data.games.game is decoded on its own as soon as it is complete, then trimmed
+to a whitelist of fields. Only one game's worth of text is ever buffered, and nothing after
+the game list is decoded at all.
+"""
+import re
+import json
+import codecs
+
+GAME_KEY_RE = re.compile(r'"games"\s*:\s*\{.*?"game"\s*:\s*', re.DOTALL)
+WHITESPACE_RE = re.compile(r'[\s,]*')
+
+_decoder = json.JSONDecoder()
+
+
+class _Buffer(object):
+    """Decoded text from an iterator of byte chunks, consumed from the front"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = u''
+        self.pos = 0
+
+    def fill(self):
+        """Read another chunk, returning False once the body is exhausted"""
+        for chunk in self.chunks:
+            if chunk:
+                self.text = self.text[self.pos:] + self.decoder.decode(chunk)
+                self.pos = 0
+                return True
+        return False
+
+    def skip(self, regex):
+        """Advance past a match of `regex`, reading more text until it doesn't touch the end"""
+        while True:
+            match = regex.search(self.text, self.pos)
+            if match and match.end() < len(self.text):
+                self.pos = match.end()
+                return True
+            if not self.fill():
+                return False
+
+    def peek(self):
+        return self.text[self.pos]
+
+    def decode(self):
+        """Decode one JSON value at the current position, reading more text as needed"""
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            self.pos = end
+            return value
+
+
+def iter_games(chunks, fields=None):
+    """Yield the games of a scoreboard body given as an iterator of byte chunks.
+
+    If `fields` is given, each game dict is restricted to those keys.
+    """
+    buf = _Buffer(chunks)
+    if not buf.skip(GAME_KEY_RE):
+        return  # No games on this day
+
+    def trim(game):
+        if fields is None:
+            return game
+        return {key: game[key] for key in fields if key in game}
+
+    if buf.peek() == '{':  # Single-game days aren't wrapped in a list
+        yield trim(buf.decode())
+        return
+
+    buf.pos += 1  # Opening bracket
+    while buf.skip(WHITESPACE_RE) and buf.peek() != ']':
+        yield trim(buf.decode())
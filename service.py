@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Resident background service for the addon.
+
+Runs for as long as Kodi does, holding the HTTP session, cookies and decoded scoreboards in
+memory and serving them to plugin invocations through resident.py. On startup, and again
+whenever the date rolls over, today's scoreboard is fetched and any missing poster and thumb
+images are composed into the artwork store, so the first listing of the day finds them
+already on disk. Queued downloads are worked through on a separate thread whenever the
+download window is open.
+"""
+import logging
+import datetime
+import threading
+import xbmc
+import mlb
+import artwork
+import downloads
+import resident
+from addon import KodiHandler, img_dir
+
+CHECK_INTERVAL = 60  # Seconds between checks for a new day
+
+log = logging.getLogger()
+
+
+def precache_day(store, date):
+    games = mlb.get_games(date)
+    artwork.precache(store, games, mlb.artwork_cache_bytes())
+    log.info("Precached artwork for {} games on {}".format(len(games), date))
+
+
+class Monitor(xbmc.Monitor):
+    def onSettingsChanged(self):
+        mlb.reset_settings()
+
+
+def run():
+    monitor = Monitor()
+    store = artwork.open_store(img_dir, mlb.profile_dir)
+    server = resident.ResidentServer()
+    server.start()
+    try:
+        _loop(monitor, store)
+    finally:
+        server.stop()
+        mlb.save_cookies()
+
+
+def run_downloads(monitor):
+    def should_stop():
+        return monitor.abortRequested() or not downloads.in_window()
+    try:
+        downloads.run_downloads(should_stop)
+    except Exception:
+        log.exception("Download run failed")
+    mlb.save_cookies()
+
+
+def _loop(monitor, store):
+    last_date = None
+    last_queued_date = None
+    downloader = None
+    while not monitor.abortRequested():
+        today = datetime.date.today()
+        if today != last_date:
+            try:
+                precache_day(store, today)
+                last_date = today
+            except Exception:
+                log.exception("Artwork precache failed; retrying later")
+            mlb.save_cookies()
+        if (today != last_queued_date and
+                mlb.get_settings().get('auto_download_favourites') == 'true'):
+            try:
+                downloads.queue_favourites()
+                last_queued_date = today
+            except Exception:
+                log.exception("Queueing favourite archives failed; retrying later")
+            mlb.save_cookies()
+
+        if ((downloader is None or not downloader.is_alive()) and downloads.in_window() and
+                downloads.download_queue.pending(downloads.budget_bytes())):
+            downloader = threading.Thread(target=run_downloads, args=(monitor,))
+            downloader.start()
+        if monitor.waitForAbort(CHECK_INTERVAL):
+            break
+    if downloader is not None:
+        downloader.join()  # Stops at its next chunk now that abort was requested
+
+
+if __name__ == '__main__':
+    log.addHandler(KodiHandler())
+    log.setLevel(logging.INFO)
+    run()
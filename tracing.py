@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""Timing spans for the addon's hot paths.
+
+Tracing is off by default; `span()` then hands back a shared no-op context manager and
+nothing is instrumented, so callers can leave spans in place unconditionally. Once
+`enable()` is called, finished spans are collected for the current plugin invocation and
+can be summarized to the log or dumped as a Chrome trace (chrome://tracing).
+"""
+import os
+import json
+import time
+import threading
+import functools
+import logging as log
+
+_enabled = False
+_origin = time.time()
+_spans = []  # (name, start, elapsed, thread id)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        _spans.append((self.name, self.start, time.time() - self.start,
+                       threading.current_thread().ident))
+        return False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name):
+    """Return a context manager timing the enclosed block as `name`"""
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def record(name, start):
+    """Record a span named `name` that started at `start` and ends now"""
+    if _enabled:
+        _spans.append((name, start, time.time() - start, threading.current_thread().ident))
+
+
+def instrument(obj, attr, name):
+    """Wrap the method `obj.attr` in a span if tracing is enabled.
+
+    `name` may be a callable, which is passed the call's arguments and returns the span name.
+    """
+    if not _enabled:
+        return
+    func = getattr(obj, attr)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        span_name = name(*args, **kwargs) if callable(name) else name
+        with _Span(span_name):
+            return func(*args, **kwargs)
+
+    setattr(obj, attr, wrapper)
+
+
+def summary():
+    """Return one line per span name with its count, total and worst-case time"""
+    totals = {}
+    for name, _, elapsed, _ in _spans:
+        count, total, worst = totals.get(name, (0, 0., 0.))
+        totals[name] = (count + 1, total + elapsed, max(worst, elapsed))
+
+    lines = ['Trace: {:.0f} ms since startup'.format((time.time() - _origin) * 1000)]
+    for name, (count, total, worst) in sorted(totals.items(), key=lambda kv: -kv[1][1]):
+        lines.append('  {:<40} {:>3}x {:>8.1f} ms (max {:.1f})'.format(name, count, total * 1000,
+                                                                     worst * 1000))
+    return '\n'.join(lines)
+
+
+def emit():
+    if _enabled:
+        log.info(summary())
+
+
+def write_trace(path):
+    """Write the collected spans as a Chrome trace event file"""
+    if not _enabled:
+        return
+    events = [{'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+               'ts': int((start - _origin) * 1e6), 'dur': int(elapsed * 1e6)}
+              for name, start, elapsed, tid in _spans]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events}, f)
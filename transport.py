@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Nate Bogdanowicz
+"""HTTP transport: a requests session with bounded timeouts, retries and per-host pools.
+
+Every request gets a default (connect, read) timeout so a hung server can't block the UI
+forever. Idempotent requests are retried with exponential backoff on connection errors
+and 5xx responses; POSTs to the MediaService are never retried automatically.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Hosts the addon talks to, each given its own connection pool
+HOSTS = (
+    'http://mlb.mlb.com',
+    'https://secure.mlb.com',
+    'https://mlb-ws.mlb.com',
+)
+CONNECT_TIMEOUT = 5
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+class TransportSession(requests.Session):
+    def __init__(self, timeout):
+        super(TransportSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(TransportSession, self).request(method, url, **kwargs)
+
+
+def _retry(retries, backoff):
+    kwargs = dict(total=retries, connect=retries, read=retries, backoff_factor=backoff,
+                  status_forcelist=RETRY_STATUSES, raise_on_status=False)
+    for methods_arg in ('allowed_methods', 'method_whitelist'):  # Renamed in urllib3 1.26
+        try:
+            return Retry(**dict(kwargs, **{methods_arg: IDEMPOTENT_METHODS}))
+        except TypeError:
+            continue
+    kwargs.pop('raise_on_status')  # Older urllib3
+    return Retry(method_whitelist=IDEMPOTENT_METHODS, **kwargs)
+
+
+def build_session(pool_size=4, timeout=10, retries=2, backoff=0.5, compression=True):
+    """Create a session with a pool of up to `pool_size` connections per host"""
+    sess = TransportSession((CONNECT_TIMEOUT, timeout))
+    retry = _retry(retries, backoff)
+    for prefix in ('http://', 'https://') + HOSTS:
+        sess.mount(prefix, HTTPAdapter(pool_connections=len(HOSTS), pool_maxsize=pool_size,
+                                       max_retries=retry))
+    if not compression:
+        sess.headers['Accept-Encoding'] = 'identity'
+    return sess